@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+PC sampling profiler using OpenOCD's Tcl RPC, covered by GNU GPLv3 or later
+
+The target side "profile" command samples a running target by halting it,
+reading pc and resuming it, at fewer than 100 samples per second, and keeps
+at most 1M 32 bit samples. This does the same from the RPC client, with the
+sample commands pipelined through OpenOcd.submit() and no sleep between
+samples, so the rate is bounded only by the debug adapter. Samples are
+counted per address as they arrive, so memory grows with the number of
+distinct addresses rather than with the sampling time, and reported as a
+flat profile, symbolised against an ELF file if one is given, and optionally
+written as a gmon.out histogram for gprof.
+
+Example:
+./ocd_pc_profile.py -t 5 -e firmware.elf -g gmon.out
+14503 samples in 5.00 s (2901 samples/s), 0 failed
+
+     %  samples  function
+  38.4     5569  memcpy
+  21.0     3046  crc32_update
+  ...
+"""
+
+import argparse
+import array
+import bisect
+import collections
+import re
+import struct
+import sys
+import time
+
+from ocd_rpc_example import OpenOcd
+
+# Sample command for a running target, the reply ends with the pc
+SAMPLE_COMMAND = "halt; set pc [get_reg pc]; resume; set pc"
+
+PC_PATTERN = re.compile(rb"0x([0-9a-fA-F]+)\s*$")
+
+SHT_SYMTAB = 2
+STT_FUNC = 2
+
+# Most buckets in a gmon.out histogram, as in OpenOCD's write_gmon()
+GMON_MAX_BUCKETS = 128 * 1024
+
+def sample(ocd, command, seconds, maxSamples=None):
+    """Sample pc with command for seconds, or until maxSamples samples were
+    taken. Return a Counter of the samples per pc, the number of replies
+    that had no pc and the time taken."""
+    counts = collections.Counter()
+    failed = 0
+
+    def store(data):
+        nonlocal failed
+        match = PC_PATTERN.search(data)
+        if match:
+            counts[int(match.group(1), 16)] += 1
+        else:
+            failed += 1
+
+    start = time.monotonic()
+    deadline = start + seconds
+    submitted = 0
+    while time.monotonic() < deadline and (maxSamples is None or submitted < maxSamples):
+        ocd.submit(command, parse=store)
+        submitted += 1
+    ocd.flush()
+    return counts, failed, time.monotonic() - start
+
+def readElfSymbols(path):
+    """Return the function symbols of an ELF file as a list of (address,
+    size, name) sorted by address, and its address size in bytes."""
+    with open(path, "rb") as f:
+        elf = f.read()
+    if elf[:4] != b"\x7fELF":
+        raise ValueError("%s is not an ELF file" % path)
+    is64 = elf[4] == 2
+    endian = "<" if elf[5] == 1 else ">"
+    if is64:
+        shoff, = struct.unpack_from(endian + "Q", elf, 0x28)
+        shentsize, shnum = struct.unpack_from(endian + "HH", elf, 0x3a)
+        sectionFormat = endian + "IIQQQQIIQQ"
+        symbolFormat = endian + "IBBHQQ"
+    else:
+        shoff, = struct.unpack_from(endian + "I", elf, 0x20)
+        shentsize, shnum = struct.unpack_from(endian + "HH", elf, 0x2e)
+        sectionFormat = endian + "IIIIIIIIII"
+        symbolFormat = endian + "IIIBBH"
+
+    sections = [struct.unpack_from(sectionFormat, elf, shoff + i * shentsize) for i in range(shnum)]
+    symbols = []
+    for _, type, _, _, offset, size, link, _, _, entsize in sections:
+        if type != SHT_SYMTAB:
+            continue
+        strtab = sections[link][4]
+        for pos in range(offset, offset + size, entsize):
+            if is64:
+                name, info, _, shndx, value, symbolSize = struct.unpack_from(symbolFormat, elf, pos)
+            else:
+                name, value, symbolSize, info, _, shndx = struct.unpack_from(symbolFormat, elf, pos)
+            if info & 0xf != STT_FUNC or shndx == 0:
+                continue
+            end = elf.index(b"\0", strtab + name)
+            symbols.append((value, symbolSize, elf[strtab + name:end].decode("utf-8", "replace")))
+    symbols.sort()
+    return symbols, 8 if is64 else 4
+
+def symbolise(counts, symbols):
+    """Sum the sample counts per address into counts per function. Addresses
+    outside every function are kept as they are."""
+    addresses = [address for address, _, _ in symbols]
+    functions = collections.Counter()
+    for pc, n in counts.items():
+        i = bisect.bisect_right(addresses, pc) - 1
+        if i >= 0:
+            address, size, name = symbols[i]
+            # A symbol without a size runs up to the next one
+            if pc < address + size or (size == 0 and i + 1 < len(symbols)):
+                functions[name] += n
+                continue
+        functions["0x%x" % pc] += n
+    return functions
+
+def printFlatProfile(counts, total, top, out=sys.stdout):
+    print("%6s %8s  %s" % ("%", "samples", "function"), file=out)
+    for name, n in counts.most_common(top):
+        print("%6.1f %8d  %s" % (100.0 * n / total, n, name), file=out)
+
+def writeGmon(path, counts, seconds, addressSize=4):
+    """Write the sample counts per pc as a gmon.out histogram, like the
+    target side "profile" command does, for a little endian target."""
+    low = min(counts)
+    high = max(counts) + 1
+    # gprof requires (high - low) >= 2
+    high = max(high, low + 2)
+    space = high - low
+    # Buckets are 2 bytes of address space
+    numBuckets = min(space // 2, GMON_MAX_BUCKETS)
+    buckets = array.array('H', bytes(2 * numBuckets))
+    for pc, n in counts.items():
+        i = (pc - low) * numBuckets // space
+        buckets[i] = min(buckets[i] + n, 0xffff)
+    if sys.byteorder != "little":
+        buckets.byteswap()
+
+    addressFormat = "<Q" if addressSize == 8 else "<I"
+    with open(path, "wb") as f:
+        # Header: magic, version and padding, then a GMON_TAG_TIME_HIST record
+        f.write(b"gmon" + struct.pack("<IIII", 1, 0, 0, 0) + b"\0")
+        f.write(struct.pack(addressFormat, low) + struct.pack(addressFormat, high))
+        f.write(struct.pack("<II", numBuckets, int(sum(counts.values()) / seconds)))
+        f.write(b"seconds".ljust(15, b"\0") + b"s")
+        f.write(buckets.tobytes())
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Statistical PC sampling profiler using OpenOCD's Tcl RPC")
+    parser.add_argument("--host", default="127.0.0.1", help="OpenOCD Tcl RPC host")
+    parser.add_argument("--port", type=int, default=6666, help="OpenOCD Tcl RPC port")
+    parser.add_argument("-t", "--time", type=float, default=10, help="seconds to sample for")
+    parser.add_argument("-n", "--samples", type=int, help="stop after this many samples")
+    parser.add_argument("-e", "--elf", help="ELF file to symbolise samples against")
+    parser.add_argument("-g", "--gmon", help="write a gmon.out histogram to this file")
+    parser.add_argument("--top", type=int, default=30, help="functions (or addresses) to list")
+    parser.add_argument("--in-flight", type=int, default=64, help="sample commands to pipeline")
+    parser.add_argument("--command", default=SAMPLE_COMMAND,
+            help="Tcl command taking one sample, its reply must end with the pc (default: %(default)s)")
+    args = parser.parse_args(args)
+
+    ocd = OpenOcd()
+    ocd.tclRpcIp = args.host
+    ocd.tclRpcPort = args.port
+    ocd.maxInFlight = args.in_flight
+    with ocd:
+        counts, failed, seconds = sample(ocd, args.command, args.time, args.samples)
+    total = sum(counts.values())
+    print("%d samples in %.2f s (%d samples/s), %d failed\n" %
+            (total, seconds, total / seconds, failed))
+    if not counts:
+        return 1
+
+    addressSize = 8 if max(counts) > 0xffffffff else 4
+    if args.elf:
+        symbols, addressSize = readElfSymbols(args.elf)
+        functions = symbolise(counts, symbols)
+    else:
+        functions = collections.Counter({"0x%x" % pc: n for pc, n in counts.items()})
+    printFlatProfile(functions, total, args.top)
+
+    if args.gmon:
+        writeGmon(args.gmon, counts, seconds, addressSize)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
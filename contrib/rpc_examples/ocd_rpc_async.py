@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+OpenOCD RPC example using asyncio, covered by GNU GPLv3 or later
+
+AsyncOpenOcd has the same send/readVariable/writeVariable/readMemory/
+writeMemory surface as OpenOcd in ocd_rpc_example.py, but on asyncio streams,
+so one event loop can drive many OpenOCD instances (e.g. one per board in a
+rack) without a thread each. Commands on one connection are pipelined:
+they are written immediately and their replies, which OpenOCD sends in
+order, are handed back to the waiting coroutines in order.
+
+Example:
+./ocd_rpc_async.py 127.0.0.1:6666 127.0.0.1:6667
+127.0.0.1:6666: halted
+127.0.0.1:6667: running
+"""
+
+import asyncio
+import collections
+import socket
+import sys
+
+from ocd_rpc_example import (NOTIFICATION_PREFIX, OpenOcd, OpenOcdError, decodeReadMemory,
+        parseNotification, strToHex, toWords)
+
+
+class AsyncOpenOcd:
+    COMMAND_TOKEN = OpenOcd.COMMAND_TOKEN
+    COMMAND_TOKEN_BYTE = OpenOcd.COMMAND_TOKEN_BYTE
+    # Largest reply accepted, a read_memory of 1M words is about 11 MB
+    REPLY_LIMIT = 1 << 26
+
+    def __init__(self, tclRpcIp="127.0.0.1", tclRpcPort=6666, verbose=False):
+        self.verbose = verbose
+        self.tclRpcIp = tclRpcIp
+        self.tclRpcPort = tclRpcPort
+        self.reader = None
+        self.writer = None
+        self.pending = collections.deque()
+        self.readerTask = None
+        # Why the reader task stopped, once it has; nothing can be sent then
+        self.failure = None
+        # See enableNotifications(), the oldest queued notifications are
+        # dropped if nobody waits
+        self.notifications = False
+        self.events = asyncio.Queue(maxsize=1024)
+        self.eventCallbacks = []
+
+    def __repr__(self):
+        return "%s:%d" % (self.tclRpcIp, self.tclRpcPort)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.disconnect()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+                self.tclRpcIp, self.tclRpcPort, limit=AsyncOpenOcd.REPLY_LIMIT)
+        self.writer.get_extra_info("socket").setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.readerTask = asyncio.get_running_loop().create_task(self._readReplies())
+
+    async def disconnect(self):
+        try:
+            await self.send("exit")
+        finally:
+            self.readerTask.cancel()
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def send(self, cmd):
+        """Send a command string to TCL RPC. Return the result that was read."""
+        return OpenOcd._decode(await self.sendRaw(cmd))
+
+    async def sendRaw(self, cmd):
+        """Like send(), but return the undecoded reply as bytes."""
+        if self.failure:
+            raise ConnectionError(self.failure)
+        data = (cmd + AsyncOpenOcd.COMMAND_TOKEN).encode("utf-8")
+        if self.verbose:
+            print("<- ", data)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(data)
+        await self.writer.drain()
+        return await future
+
+    async def enableNotifications(self, callback=None):
+        """Like OpenOcd.enableNotifications(). Notifications are passed to
+        the callbacks from the reader task and queued in events, see
+        waitEvent() and eventStream()."""
+        if callback:
+            self.eventCallbacks.append(callback)
+        self.notifications = True
+        await self.send("tcl notifications on")
+
+    async def waitEvent(self, match=None, timeout=None):
+        """Like OpenOcd.waitEvent(), without blocking other coroutines."""
+        async def wait():
+            while True:
+                notification = await self.events.get()
+                if match is None or match(notification):
+                    return notification
+        try:
+            return await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def waitHalt(self, timeout=None):
+        return await self.waitEvent(lambda n: n == ("target_event", "halted"), timeout)
+
+    async def eventStream(self):
+        """Iterate over notifications as they arrive:
+
+        async for notification in ocd.eventStream():
+            ..."""
+        while True:
+            yield await self.events.get()
+
+    async def _readReplies(self):
+        """Hand every reply to the oldest waiting command, and every
+        notification to the callbacks and the events queue."""
+        try:
+            while True:
+                data = await self.reader.readuntil(AsyncOpenOcd.COMMAND_TOKEN_BYTE)
+                if self.verbose:
+                    print("-> ", data)
+                if self.notifications and data.startswith(NOTIFICATION_PREFIX):
+                    notification = parseNotification(data[:-1])
+                    if self.events.full():
+                        self.events.get_nowait()
+                    self.events.put_nowait(notification)
+                    for callback in self.eventCallbacks:
+                        callback(notification)
+                    continue
+                future = self.pending.popleft()
+                if not future.cancelled():
+                    future.set_result(data[:-1])
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.failure = "OpenOCD closed the connection: %s" % e
+        except Exception as e:
+            # e.g. a reply longer than REPLY_LIMIT
+            self.failure = "reading from OpenOCD failed: %r" % e
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(self.failure))
+
+    async def readVariable(self, address):
+        raw = (await self.send("mdw 0x%x" % address)).split(": ")
+        return None if (len(raw) < 2) else strToHex(raw[1])
+
+    async def readMemory(self, wordLen, address, n):
+        output = await self.sendRaw("read_memory 0x%x %d %d" % (address, wordLen, n))
+        return decodeReadMemory(output, wordLen)
+
+    async def writeVariable(self, address, value):
+        assert value is not None
+        await self.send("mww 0x%x 0x%x" % (address, value))
+
+    async def writeMemory(self, wordLen, address, data, chunkSize=0x10000, inFlight=4):
+        """Like OpenOcd.writeMemory(), with inFlight chunks pipelined. A
+        chunk's command is only built once it may be sent, so no more than
+        inFlight of them exist at a time."""
+        words = toWords(data, wordLen)
+        n = chunkSize // words.itemsize
+        slots = asyncio.Semaphore(inFlight)
+
+        async def writeChunk(offset):
+            async with slots:
+                return await self.send("write_memory 0x%x %d {%s}" % (
+                        address + offset * words.itemsize, wordLen,
+                        " ".join(map("0x%x".__mod__, words[offset:offset + n]))))
+
+        errors = await asyncio.gather(*(writeChunk(offset) for offset in range(0, len(words), n)))
+        error = next(filter(None, errors), None)
+        if error:
+            raise OpenOcdError(error)
+
+
+async def connectAll(addresses, verbose=False):
+    """Connect to every (ip, port) in addresses concurrently. Return the
+    clients in the same order, with the exception in place of any client
+    that could not connect."""
+    clients = [AsyncOpenOcd(ip, port, verbose) for ip, port in addresses]
+    results = await asyncio.gather(*(client.connect() for client in clients),
+            return_exceptions=True)
+    return [client if result is None else result for client, result in zip(clients, results)]
+
+async def _failed(error):
+    return error
+
+async def fanOut(clients, operation, *args):
+    """Run one operation on many targets concurrently and gather the results,
+    in the order of clients. operation is an AsyncOpenOcd method name, e.g.
+    fanOut(clients, "readMemory", 32, addr, 16), or a coroutine function
+    taking the client as its first argument. A target that fails yields its
+    exception instead of a result, so one bad board does not hide the rest.
+    Exceptions in clients (from connectAll()) are passed through as results."""
+    calls = []
+    for client in clients:
+        if isinstance(client, BaseException):
+            calls.append(_failed(client))
+        elif isinstance(operation, str):
+            calls.append(getattr(client, operation)(*args))
+        else:
+            calls.append(operation(client, *args))
+    return await asyncio.gather(*calls, return_exceptions=True)
+
+
+if __name__ == "__main__":
+
+    def parseAddress(text):
+        ip, _, port = text.rpartition(":")
+        return (ip or "127.0.0.1", int(port))
+
+    async def pollAll(addresses):
+        clients = await connectAll(addresses)
+        try:
+            states = await fanOut(clients, "send", "[target current] curstate")
+            for address, state in zip(addresses, states):
+                print("%s:%d: %s" % (address + (state,)))
+        finally:
+            await asyncio.gather(*(client.disconnect() for client in clients
+                    if isinstance(client, AsyncOpenOcd)), return_exceptions=True)
+
+    asyncio.run(pollAll([parseAddress(a) for a in sys.argv[1:] or [":6666"]]))
@@ -27,6 +27,34 @@ memory (after): ['0x00000001', '0x00000000', '0xaaaaaaaa', '0x00000023',
 
 import socket
 import itertools
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import array
+import mmap
+import os
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array typecodes for read_memory/write_memory word widths
+WORD_TYPECODES = {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}
+
+# Most words one read_memory command may read
+READ_MEMORY_MAX_COUNT = 65536
+
+
+class OpenOcdError(Exception):
+    """OpenOCD replied with an error message instead of the expected result."""
 
 def strToHex(data):
     return map(strToHex, data) if isinstance(data, list) else int(data, 16)
@@ -39,9 +67,335 @@ def compareData(a, b):
         if i != j:
             print("difference at %d: %s != %s" % (num, hexify(i), hexify(j)))
 
+# Block size compared at once when diffing without NumPy
+DIFF_BLOCK = 256
+
+def diffRuns(address, expected, actual):
+    """Compare the bytes-like expected and actual, the memory contents at
+    address. Return the runs of differing bytes as a list of (address,
+    expected, actual)."""
+    if numpy is not None:
+        diff = numpy.flatnonzero(numpy.frombuffer(expected, dtype=numpy.uint8) !=
+                numpy.frombuffer(actual, dtype=numpy.uint8))
+        breaks = numpy.flatnonzero(numpy.diff(diff) != 1) + 1
+        runs = [(int(run[0]), int(run[-1]) + 1)
+                for run in (numpy.split(diff, breaks) if len(diff) else [])]
+    else:
+        # Only blocks that differ are compared byte by byte
+        diff = [i for block in range(0, len(expected), DIFF_BLOCK)
+                if expected[block:block + DIFF_BLOCK] != actual[block:block + DIFF_BLOCK]
+                for i in range(block, min(block + DIFF_BLOCK, len(expected)))
+                if expected[i] != actual[i]]
+        runs = []
+        for _, run in itertools.groupby(enumerate(diff), lambda x: x[1] - x[0]):
+            run = list(run)
+            runs.append((run[0][1], run[-1][1] + 1))
+    return [(address + start, bytes(expected[start:end]), bytes(actual[start:end]))
+            for start, end in runs]
+
+def decodeReadMemory(data, wordLen):
+    """Parse a read_memory reply (str, bytes or memoryview) into an array of
+    words of wordLen bits."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    tokens = bytes(data).split()
+    try:
+        # map() with the int builtin keeps the per-word loop in C
+        return array.array(WORD_TYPECODES[wordLen], map(int, tokens, itertools.repeat(16)))
+    except ValueError:
+        # OpenOCD appends its error message to the values read so far
+        error = next(i for i, x in enumerate(tokens) if not x.startswith(b"0x"))
+        raise OpenOcdError(b" ".join(tokens[error:]).decode("utf-8", "replace")) from None
+
+def decodeReadMemoryNumpy(data, wordLen):
+    """Like decodeReadMemory(), but return a NumPy array sharing its buffer.
+    Needs NumPy."""
+    return numpy.frombuffer(decodeReadMemory(data, wordLen), dtype=WORD_TYPECODES[wordLen])
+
+def wordsToBytes(words):
+    """Target memory contents of an array of words, for a little endian target."""
+    if sys.byteorder != "little":
+        words = array.array(words.typecode, words)
+        words.byteswap()
+    return words.tobytes()
+
+def bytesToWords(data, wordLen):
+    """Array of words of wordLen bits holding the target memory contents
+    data, for a little endian target. The inverse of wordsToBytes()."""
+    words = array.array(WORD_TYPECODES[wordLen])
+    if len(data) % words.itemsize:
+        raise ValueError("data is not a multiple of %d bytes" % words.itemsize)
+    words.frombytes(data)
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words
+
+def toWords(data, wordLen):
+    """Words of wordLen bits to write from data, which is a bytes-like object
+    of target memory contents, an array.array or NumPy array of words, or any
+    iterable of ints."""
+    typecode = WORD_TYPECODES[wordLen]
+    if isinstance(data, array.array) and data.typecode == typecode:
+        return data
+    if numpy is not None and isinstance(data, numpy.ndarray):
+        words = array.array(typecode)
+        words.frombytes(numpy.ascontiguousarray(data, dtype=typecode).tobytes())
+        return words
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return bytesToWords(data, wordLen)
+    return array.array(typecode, data)
+
+# Verbs that neither change memory or registers nor let the target run.
+# Caches are kept across these and cleared by any other command.
+CACHE_SAFE_COMMANDS = frozenset(("read_memory", "mdd", "mdw", "mdh", "mdb", "get_reg",
+        "echo", "exit", "tcl"))
+
+def commandVerb(cmd):
+    # Only split the start, commands such as write_memory can be large
+    words = cmd[:64].split(None, 1)
+    return words[0] if words else ""
+
+def isCacheSafe(cmd):
+    return commandVerb(cmd) in CACHE_SAFE_COMMANDS
+
+# Register lines in the output of "reg", "(0) zero (/32): 0x00000000"
+REG_LIST_PATTERN = re.compile(r"^\(\d+\) (\S+) \(/\d+\)", re.MULTILINE)
+
+# Asynchronous message from OpenOCD's Tcl notification stream, e.g.
+# Notification("target_event", "halted") or Notification("target_state", "running")
+Notification = collections.namedtuple("Notification", "type value")
+
+NOTIFICATION_PREFIX = b"type target_"
+
+def parseNotification(data):
+    """Parse "type target_event event halted\r\n" into a Notification."""
+    parts = str(data, "utf-8").split()
+    return Notification(parts[1], parts[3] if len(parts) > 3 else "")
+
+def chunks(iterable, n):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+class OcdFuture:
+    """Reply to a command submitted with OpenOcd.submit(). The reply is read
+    from the socket when result() is called, together with the replies to
+    all commands submitted before it.
+
+    If parse is given, it is called with the reply as a memoryview into the
+    receive buffer, and its return value (or exception) becomes the result."""
+    def __init__(self, ocd, raw, parse=None):
+        self.ocd = ocd
+        self.raw = raw
+        self.parse = parse
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        while not self._done:
+            self.ocd._completeOne()
+        if self._error:
+            raise self._error
+        return self._result
+
+    def _set(self, data):
+        if self.parse:
+            try:
+                self._result = self.parse(data)
+            except Exception as e:
+                self._error = e
+        else:
+            # A raw reply is copied, the receive buffer is reused for later replies
+            self._result = bytes(data) if self.raw else OpenOcd._decode(data)
+        self._done = True
+
+
+class MemoryCache:
+    """Page granular, LRU bounded cache of target memory for OpenOcd, set
+    with ocd.cache = MemoryCache(). Whole pages are read (as 32 bit words)
+    on a miss, so only use it on memory without read side effects.
+
+    The cache sees every command sent. Commands known not to change target
+    state (CACHE_SAFE_COMMANDS) keep it, the client's own writes update it
+    (write-through) and any other command, e.g. resume, step or reset,
+    clears it and starts a new epoch. Cached contents are thus only those
+    read since the target last halted, as long as it is not running while
+    the cache is used. Reads of more than maxPages pages bypass it."""
+    def __init__(self, pageSize=4096, maxPages=256):
+        if pageSize & (pageSize - 1) or not 4 <= pageSize <= 0x40000:
+            raise ValueError("pageSize must be a power of 2 from 4 to 0x40000")
+        self.pageSize = pageSize
+        self.maxPages = maxPages
+        self.pages = collections.OrderedDict()
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.pages.clear()
+        self.epoch += 1
+
+    def observe(self, cmd):
+        """Called with every command sent, clears the cache unless the
+        command is known to be safe."""
+        if self.pages and not isCacheSafe(cmd):
+            self.clear()
+
+    def missing(self, address, size):
+        """Base addresses of the pages of address..address+size that are
+        not cached. Those that are become the most recently used."""
+        first = address & -self.pageSize
+        pages = range(first, address + size, self.pageSize)
+        missing = []
+        for page in pages:
+            if page in self.pages:
+                self.pages.move_to_end(page)
+            else:
+                missing.append(page)
+        self.hits += len(pages) - len(missing)
+        self.misses += len(missing)
+        return missing
+
+    def insert(self, page, data):
+        self.pages[page] = bytearray(data)
+        if len(self.pages) > self.maxPages:
+            self.pages.popitem(last=False)
+
+    def read(self, address, size, fetched=None):
+        """Bytes at address..address+size, all of whose pages are cached or
+        in fetched, a dict of page base address to contents."""
+        out = bytearray(size)
+        for page, start, end in self._spans(address, size):
+            data = fetched.get(page) if fetched else None
+            if data is None:
+                data = self.pages[page]
+            out[start - address:end - address] = data[start - page:end - page]
+        return out
+
+    def pageCount(self, address, size):
+        return len(range(address & -self.pageSize, address + size, self.pageSize))
+
+    def write(self, address, data):
+        """Update the cached pages overlapping a write of data to address."""
+        for page, start, end in self._spans(address, len(data)):
+            cached = self.pages.get(page)
+            if cached is not None:
+                cached[start - page:end - page] = data[start - address:end - address]
+
+    def _spans(self, address, size):
+        # (page, start, end) for every page overlapping address..address+size
+        for page in range(address & -self.pageSize, address + size, self.pageSize):
+            yield page, max(page, address), min(page + self.pageSize, address + size)
+
+
+# Timing of one command, see CommandTimings. start is in seconds since the
+# epoch, the phases are durations in seconds.
+CommandSpan = collections.namedtuple("CommandSpan", "verb start send firstByte terminator parse")
+
+class CommandTimings:
+    """Per verb timings of the commands sent by an OpenOcd, see
+    OpenOcd.enableTimings(). The time of a command is split into phases:
+
+    send        writing it to the socket
+    firstByte   from then until the first byte of the reply, i.e. OpenOCD
+                executing it (after any commands pipelined before it)
+    terminator  from the first byte until the end of the reply
+    parse       decoding the reply in the client
+
+    Each phase is summed and counted in a histogram of power of 2
+    microsecond buckets. If spanHook is set, it is called with a
+    CommandSpan for every command, e.g. to export it to a tracer."""
+    PHASES = ("send", "firstByte", "terminator", "parse")
+    BUCKETS = 32
+
+    def __init__(self, spanHook=None):
+        self.spanHook = spanHook
+        self.started = time.perf_counter()
+        self.epoch = time.time() - self.started
+        # Spans of commands sent, oldest first, and of the last reply received,
+        # whose parse time is not known yet:
+        # [verb, start, send, sent, firstByte, terminator, parse]
+        self.open = collections.deque()
+        self.last = None
+        # verb -> [count, {phase: [total, histogram]}]
+        self.verbs = {}
+
+    def sent(self, cmds, start, end):
+        # A batch is written at once, each command gets its share
+        share = (end - start) / len(cmds)
+        for cmd in cmds:
+            self.open.append([commandVerb(cmd), start, share, end, 0.0, 0.0, 0.0])
+
+    def received(self, firstByte, terminator):
+        self._finish()
+        if not self.open:
+            return
+        span = self.open.popleft()
+        span[4] = firstByte
+        span[5] = terminator
+        self.last = span
+
+    def parsed(self, duration):
+        if self.last:
+            self.last[6] += duration
+
+    def _finish(self):
+        if not self.last:
+            return
+        verb, start, send, sent, firstByte, terminator, parse = self.last
+        self.last = None
+        # Bytes already buffered may have arrived before the command was sent
+        span = CommandSpan(verb, self.epoch + start, send, max(firstByte - sent, 0.0),
+                terminator - firstByte, parse)
+        stats = self.verbs.get(verb)
+        if stats is None:
+            stats = self.verbs[verb] = [0, {phase: [0.0, array.array('Q', bytes(8 * CommandTimings.BUCKETS))]
+                    for phase in CommandTimings.PHASES}]
+        stats[0] += 1
+        for phase, duration in zip(CommandTimings.PHASES, span[2:]):
+            total = stats[1][phase]
+            total[0] += duration
+            total[1][min(int(duration * 1e6).bit_length(), CommandTimings.BUCKETS - 1)] += 1
+        if self.spanHook:
+            self.spanHook(span)
+
+    @staticmethod
+    def _percentile(histogram, count, fraction):
+        # Upper bound of the bucket holding the fraction-th command
+        rank = fraction * count
+        for bucket, n in enumerate(histogram):
+            rank -= n
+            if rank <= 0:
+                return (1 << bucket) / 1e6
+        return (1 << (len(histogram) - 1)) / 1e6
+
+    def stats(self):
+        """Summary of where time went: the wall time since timing started,
+        and per verb the command count and for each phase the total, p50 and
+        p99 in seconds. With pipelining, phases of different commands
+        overlap, so they can add up to more than the wall time."""
+        self._finish()
+        commands = {}
+        for verb, (count, phases) in self.verbs.items():
+            commands[verb] = {"count": count}
+            for phase, (total, histogram) in phases.items():
+                commands[verb][phase] = {"total": total,
+                        "p50": CommandTimings._percentile(histogram, count, 0.5),
+                        "p99": CommandTimings._percentile(histogram, count, 0.99)}
+        return {"wall": time.perf_counter() - self.started, "commands": commands}
+
 
 class OpenOcd:
     COMMAND_TOKEN = '\x1a'
+    COMMAND_TOKEN_BYTE = b'\x1a'
     def __init__(self, verbose=False):
         self.verbose = verbose
         self.tclRpcIp       = "127.0.0.1"
@@ -50,6 +404,47 @@ class OpenOcd:
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        # Receive buffer: replies are read into rxBuffer[rxStart:rxEnd]; it
+        # only grows when a single reply does not fit.
+        self.rxBuffer = bytearray(self.bufferSize)
+        self.rxStart = 0
+        self.rxEnd = 0
+
+        # Commands sent whose reply has not been read yet, oldest first. At
+        # most maxInFlight are outstanding, so neither side can stall on a
+        # full socket buffer.
+        self.pending = collections.deque()
+        self.maxInFlight = 64
+
+        # Optional CommandTimings, see enableTimings(). rxTime is when data
+        # was last received, rxFirstByte and rxTerminator when the first and
+        # last byte of the last message were.
+        self.timings = None
+        self.rxTime = self.rxFirstByte = self.rxTerminator = 0.0
+
+        # writeMemory() stages writes of at least this many bytes through a
+        # temporary file and load_image, which skips formatting and parsing
+        # a Tcl list per word. Only used when OpenOCD can open the file, see
+        # _sharesFiles(); None disables it.
+        self.loadImageThreshold = 1 << 20
+        # Whether OpenOCD sees this client's temporary files, None until
+        # checked
+        self.filesShared = None
+
+        # Optional MemoryCache used by readVariable() and readMemory()
+        self.cache = None
+
+        # Register values read by read_registers() since the target halted,
+        # and the names of all registers, which do not change
+        self.registers = {}
+        self.registerNames = None
+
+        # Notifications, see enableNotifications(). Those not yet consumed by
+        # waitEvent() are queued, the oldest are dropped if nobody waits.
+        self.notifications = False
+        self.events = collections.deque(maxlen=1024)
+        self.eventCallbacks = []
+
     def __enter__(self):
         self.connect()
         return self
@@ -59,6 +454,9 @@ class OpenOcd:
 
     def connect(self):
         self.sock.connect((self.tclRpcIp, self.tclRpcPort))
+        # Submitted commands go out one small write at a time, don't let Nagle
+        # hold them back waiting for an ACK
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def disconnect(self):
         try:
@@ -68,45 +466,640 @@ class OpenOcd:
 
     def send(self, cmd):
         """Send a command string to TCL RPC. Return the result that was read."""
-        data = (cmd + OpenOcd.COMMAND_TOKEN).encode("utf-8")
+        self.flush()
+        self._send([cmd])
+        return self._recv()
+
+    def enableTimings(self, spanHook=None):
+        """Start recording per command timings, see CommandTimings and
+        stats()."""
+        self.flush()
+        self.timings = CommandTimings(spanHook)
+
+    def stats(self):
+        """Summary of the timings recorded since enableTimings(), see
+        CommandTimings.stats(). Raise OpenOcdError if timings are off."""
+        if self.timings is None:
+            raise OpenOcdError("timings are off, call enableTimings() first")
+        return self.timings.stats()
+
+    def sendRaw(self, cmd):
+        """Like send(), but return the undecoded reply as a memoryview. The
+        view is only valid until the next command is sent."""
+        self.flush()
+        self._send([cmd])
+        return self._recvRaw()
+
+    def _sendCacheSafe(self, cmd):
+        # send() for commands that update the cache themselves
+        self.flush()
+        self._send([cmd], cacheSafe=True)
+        return self._recv()
+
+    def submit(self, cmd, raw=False, parse=None):
+        """Send a command without waiting for its reply. Return an OcdFuture
+        for the reply, as a string, as bytes if raw is set, or as returned by
+        parse (see OcdFuture)."""
+        return self._submit(cmd, raw, parse)
+
+    def _submit(self, cmd, raw=False, parse=None, cacheSafe=False):
+        while len(self.pending) >= self.maxInFlight:
+            self._completeOne()
+        self._send([cmd], cacheSafe)
+        future = OcdFuture(self, raw, parse)
+        self.pending.append(future)
+        return future
+
+    def pipeline(self, cmds, raw=False):
+        """Send all commands, keeping up to maxInFlight of them outstanding,
+        and return their replies in order. The commands are written in
+        batches, so N commands cost about N / (maxInFlight / 2) round trips
+        instead of N."""
+        futures = []
+        for batch in chunks(cmds, max(self.maxInFlight // 2, 1)):
+            while self.pending and len(self.pending) + len(batch) > self.maxInFlight:
+                self._completeOne()
+            self._send(batch)
+            for _ in batch:
+                future = OcdFuture(self, raw)
+                self.pending.append(future)
+                futures.append(future)
+        return [future.result() for future in futures]
+
+    def flush(self):
+        """Read the replies to all submitted commands."""
+        while self.pending:
+            self._completeOne()
+
+    def _completeOne(self):
+        future = self.pending.popleft()
+        data = self._recvRaw()
+        start = time.perf_counter()
+        future._set(data)
+        self._parsed(start)
+
+    def _parsed(self, start):
+        # The reply last received took from start until now to parse
+        if self.timings:
+            self.timings.parsed(time.perf_counter() - start)
+
+    def _send(self, cmds, cacheSafe=False):
+        # cacheSafe commands update the cache themselves
+        if not cacheSafe:
+            for cmd in cmds:
+                if self.registers and not isCacheSafe(cmd):
+                    self.registers = {}
+                if self.cache is not None:
+                    self.cache.observe(cmd)
+        data = "".join(cmd + OpenOcd.COMMAND_TOKEN for cmd in cmds).encode("utf-8")
         if self.verbose:
             print("<- ", data)
 
-        self.sock.send(data)
-        return self._recv()
+        if self.timings:
+            start = time.perf_counter()
+            self.sock.sendall(data)
+            self.timings.sent(cmds, start, time.perf_counter())
+        else:
+            self.sock.sendall(data)
+
+    @staticmethod
+    def _decode(data):
+        return str(data, "utf-8").lstrip()
 
     def _recv(self):
         """Read from the stream until the token (\x1a) was received."""
-        data = bytes()
+        data = self._recvRaw()
+        start = time.perf_counter()
+        result = OpenOcd._decode(data)
+        self._parsed(start)
+        return result
+
+    def enableNotifications(self, callback=None):
+        """Have OpenOCD send target events, state changes and resets on this
+        connection. Each is passed to callback and every function in
+        eventCallbacks as a Notification, as soon as it is read, and queued
+        for waitEvent()."""
+        if callback:
+            self.eventCallbacks.append(callback)
+        self.send("tcl notifications on")
+        self.notifications = True
+
+    def waitEvent(self, match=None, timeout=None):
+        """Return the next notification for which match(notification) is
+        true (any if match is None), or None after timeout seconds. Nothing
+        is sent while waiting, the call just blocks on the socket. Earlier
+        notifications are consumed from the queue first, clear events
+        before starting the target to only see new ones:
+
+        ocd.events.clear()
+        ocd.send("resume")
+        ocd.waitHalt()"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            while self.events:
+                notification = self.events.popleft()
+                if match is None or match(notification):
+                    return notification
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.sock.settimeout(remaining)
+            try:
+                data = self._recvMessage()
+            except socket.timeout:
+                return None
+            finally:
+                self.sock.settimeout(None)
+            if self._isNotification(data):
+                self._notify(data)
+            elif self.pending:
+                self._replyReceived()
+                self.pending.popleft()._set(data)
+            else:
+                raise OpenOcdError("unexpected reply: %r" % bytes(data))
+
+    def waitHalt(self, timeout=None):
+        """Wait for the target to halt, e.g. at a breakpoint. Return the
+        notification, or None after timeout seconds."""
+        return self.waitEvent(lambda n: n == ("target_event", "halted"), timeout)
+
+    def _isNotification(self, data):
+        return self.notifications and data[:len(NOTIFICATION_PREFIX)] == NOTIFICATION_PREFIX
+
+    def _notify(self, data):
+        notification = parseNotification(data)
+        # The target ran, e.g. resumed by another client
+        if notification.type in ("target_event", "target_reset"):
+            self.registers = {}
+            if self.cache is not None:
+                self.cache.clear()
+        self.events.append(notification)
+        for callback in self.eventCallbacks:
+            callback(notification)
+
+    def _recvRaw(self):
+        """Read the next reply, handling any notifications received before
+        it. Return the reply without the token as a memoryview into the
+        receive buffer."""
         while True:
-            chunk = self.sock.recv(self.bufferSize)
-            data += chunk
-            if bytes(OpenOcd.COMMAND_TOKEN, encoding="utf-8") in chunk:
+            data = self._recvMessage()
+            if not self._isNotification(data):
+                self._replyReceived()
+                return data
+            self._notify(data)
+
+    def _replyReceived(self):
+        if self.timings:
+            self.timings.received(self.rxFirstByte, self.rxTerminator)
+
+    def _recvMessage(self):
+        """Read from the stream until the token (\x1a) was received. Return
+        the message without the token as a memoryview into the receive buffer.
+
+        Only newly received bytes are scanned for the token, and bytes after
+        it are kept for the next reply, so a reply of n bytes costs O(n). The
+        buffer state is saved after every read, so a partial message is kept
+        if the socket times out, e.g. in waitEvent()."""
+        buf = self.rxBuffer
+        start = self.rxStart
+        end = self.rxEnd
+        if start == end:
+            start = end = 0
+            firstByte = None
+        else:
+            firstByte = self.rxTime
+        scan = start
+        while True:
+            pos = buf.find(OpenOcd.COMMAND_TOKEN_BYTE, scan, end)
+            if pos >= 0:
                 break
+            scan = end
+            if end == len(buf):
+                # Out of room: move the partial reply to the front, or grow the
+                # buffer if it is already there. A fresh buffer is allocated
+                # rather than resizing, as views handed out may still exist.
+                if start > 0:
+                    buf[:end - start] = buf[start:end]
+                else:
+                    buf = bytearray(2 * len(buf))
+                    buf[:end] = self.rxBuffer[:end]
+                    self.rxBuffer = buf
+                scan -= start
+                end -= start
+                start = 0
+                self.rxStart = start
+                self.rxEnd = end
+            received = self.sock.recv_into(memoryview(buf)[end:])
+            if received == 0:
+                raise ConnectionError("OpenOCD closed the connection")
+            end += received
+            self.rxStart = start
+            self.rxEnd = end
+            self.rxTime = time.perf_counter()
+            if firstByte is None:
+                firstByte = self.rxTime
 
+        self.rxStart = pos + 1
+        self.rxEnd = end
+        self.rxFirstByte = firstByte
+        self.rxTerminator = self.rxTime
+        data = memoryview(buf)[start:pos]
         if self.verbose:
-            print("-> ", data)
-
-        data = data.decode("utf-8").strip()
-        data = data[:-1] # strip trailing \x1a
+            print("-> ", bytes(data))
 
         return data
 
     def readVariable(self, address):
+        if self.cache is not None:
+            return self.readMemory(32, address, 1)[0]
         raw = self.send("mdw 0x%x" % address).split(": ")
         return None if (len(raw) < 2) else strToHex(raw[1])
 
-    def readMemory(self, wordLen, address, n):
-        output = self.send("read_memory 0x%x %d %d" % (address, wordLen, n))
-        return [*map(lambda x: int(x, 16), output.split(" "))]
+    def read_registers(self, names=None, force=False):
+        """Return a dict of register name to value for the registers in
+        names, or all registers. Registers are read in a single Tcl script,
+        so this is one round trip however many there are, and values are
+        cached until the target runs (see CACHE_SAFE_COMMANDS). If force is
+        set, they are read from the target again, bypassing this cache and
+        OpenOCD's own register cache (get_reg -force). Registers that cannot
+        be read are left out."""
+        if names is None:
+            if self.registerNames is None:
+                self.registerNames = REG_LIST_PATTERN.findall(self._sendCacheSafe("reg"))
+            names = self.registerNames
+        missing = list(names) if force else [name for name in names if name not in self.registers]
+        if missing:
+            # One get_reg per register, so one that fails does not fail the rest
+            values = self._sendCacheSafe("set _regs {}; foreach _reg {%s} "
+                    "{if {![catch {get_reg %s$_reg} _val]} {lappend _regs {*}$_val}}; set _regs" %
+                    (" ".join(missing), "-force " if force else "")).split()
+            # Unreadable registers are cached as None, not to retry each time
+            self.registers.update(dict.fromkeys(missing))
+            self.registers.update(zip(values[::2], map(strToHex, values[1::2])))
+        return {name: self.registers[name] for name in names if self.registers[name] is not None}
+
+    def readMemory(self, wordLen, address, n, asNumpy=False):
+        """Read n words of wordLen bits. Return an array.array of the words,
+        or a NumPy array if asNumpy is set."""
+        if self.cache is not None:
+            words = self._readCached(address, n * wordLen // 8, wordLen)
+            if words is not None:
+                return numpy.frombuffer(words, dtype=words.typecode) if asNumpy else words
+        output = self.sendRaw("read_memory 0x%x %d %d" % (address, wordLen, n))
+        start = time.perf_counter()
+        if asNumpy:
+            words = decodeReadMemoryNumpy(output, wordLen)
+        else:
+            words = decodeReadMemory(output, wordLen)
+        self._parsed(start)
+        return words
+
+    def _readCached(self, address, size, wordLen):
+        """Read through the cache, fetching missing pages with pipelined
+        read_memory commands. Return None if a page cannot be read, e.g. as
+        it is only partly mapped, or if the read spans more pages than the
+        cache holds, so the caller falls back to reading only what was asked
+        for."""
+        cache = self.cache
+        if cache.pageCount(address, size) > cache.maxPages:
+            return None
+        pageWords = cache.pageSize // 4
+        futures = []
+        for page in cache.missing(address, size):
+            futures.append((page, self.submit("read_memory 0x%x 32 %d" % (page, pageWords),
+                    parse=functools.partial(decodeReadMemory, wordLen=32))))
+        fetched = {}
+        for page, future in futures:
+            try:
+                words = future.result()
+            except OpenOcdError:
+                return None
+            if len(words) != pageWords:
+                return None
+            fetched[page] = wordsToBytes(words)
+        # Build the result before inserting, which may evict pages it uses
+        data = cache.read(address, size, fetched)
+        for page, pageData in fetched.items():
+            cache.insert(page, pageData)
+        return bytesToWords(data, wordLen)
+
+    def verify(self, address, expected, minDiff=0x1000):
+        """Compare target memory at address with the bytes-like expected.
+        Return the runs of differing bytes as a list of (address, expected,
+        actual), empty if memory matches.
+
+        If OpenOCD can open this client's temporary files, e.g. runs on this
+        host, the region is first checked against an on target checksum
+        (verify_image_checksum of a temporary file), and a
+        mismatching region is bisected with further checksums down to
+        minDiff bytes, so only those ranges are read back. Otherwise the
+        whole region is read back and compared."""
+        expected = memoryview(expected).cast("B")
+        if not self._sharesFiles():
+            return diffRuns(address, expected, self._readBytes(address, len(expected)))
+
+        runs = []
+        for start, end in self._mismatchingRanges(address, expected, minDiff):
+            actual = self._readBytes(address + start, end - start)
+            runs += diffRuns(address + start, expected[start:end], actual)
+        return runs
+
+    def _mismatchingRanges(self, address, expected, minDiff):
+        """Offsets (start, end) into expected of ranges of at most minDiff
+        bytes whose checksum does not match, in order. The checksums of each
+        level of the bisection are pipelined."""
+        mismatching = []
+        ranges = [(0, len(expected))] if len(expected) else []
+        with tempfile.TemporaryDirectory(prefix="ocd_rpc_") as directory:
+            while ranges:
+                futures = []
+                for start, end in ranges:
+                    path = os.path.join(directory, "%x.bin" % start)
+                    with open(path, "wb") as f:
+                        f.write(expected[start:end])
+                    futures.append((start, end, self._submit(
+                            "verify_image_checksum {%s} 0x%x bin" % (path, address + start),
+                            cacheSafe=True)))
+                ranges = []
+                for start, end, future in futures:
+                    if "verified %d bytes" % (end - start) in future.result():
+                        continue
+                    if end - start <= minDiff:
+                        mismatching.append((start, end))
+                        continue
+                    # Split at a word boundary where possible
+                    middle = start + ((end - start) // 2 & ~3 or (end - start) // 2)
+                    ranges += [(start, middle), (middle, end)]
+        return sorted(mismatching)
+
+    def _readBytes(self, address, size, chunkSize=0x10000, wordLen=None):
+        """Read size bytes at address, in pipelined read_memory commands of
+        up to chunkSize bytes, of wordLen bit words (32 bits if aligned)."""
+        if wordLen is None:
+            wordLen = 32 if address % 4 == 0 and size % 4 == 0 else 8
+        futures = [self.submit("read_memory 0x%x %d %d" % (
+                address + offset, wordLen, min(chunkSize, size - offset) * 8 // wordLen),
+                parse=functools.partial(decodeReadMemory, wordLen=wordLen))
+                for offset in range(0, size, chunkSize)]
+        return b"".join(wordsToBytes(future.result()) for future in futures)
+
+    def dump_memory(self, address, size, path, wordLen=32, chunkSize=0x10000, inFlight=4):
+        """Read size bytes of target memory starting at address into the file
+        at path. The range is read in chunkSize byte read_memory commands,
+        at most READ_MEMORY_MAX_COUNT words each, inFlight of them pipelined,
+        and each reply is parsed straight into a memory map of the file."""
+        wordBytes = wordLen // 8
+        if address % wordBytes or size % wordBytes or chunkSize % wordBytes:
+            raise ValueError("address, size and chunkSize must be multiples of %d" % wordBytes)
+        if chunkSize <= 0:
+            raise ValueError("chunkSize must be positive")
+        chunkSize = min(chunkSize, READ_MEMORY_MAX_COUNT * wordBytes)
+
+        with open(path, "w+b") as f:
+            f.truncate(size)
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), size) as out:
+                maxInFlight, self.maxInFlight = self.maxInFlight, inFlight
+                futures = []
+                try:
+                    for offset in range(0, size, chunkSize):
+                        n = min(chunkSize, size - offset)
+                        futures.append(self.submit(
+                                "read_memory 0x%x %d %d" % (address + offset, wordLen, n // wordBytes),
+                                parse=functools.partial(self._storeWords, out, offset, n, wordLen)))
+                finally:
+                    self.flush()
+                    self.maxInFlight = maxInFlight
+                for future in futures:
+                    future.result()
+
+    @staticmethod
+    def _storeWords(out, offset, n, wordLen, data):
+        words = wordsToBytes(decodeReadMemory(data, wordLen))
+        if len(words) != n:
+            raise OpenOcdError("read_memory returned %d bytes at offset 0x%x, expected %d" %
+                    (len(words), offset, n))
+        out[offset:offset + n] = words
 
     def writeVariable(self, address, value):
         assert value is not None
-        self.send("mww 0x%x 0x%x" % (address, value))
+        self._sendCacheSafe("mww 0x%x 0x%x" % (address, value))
+        if self.cache is not None:
+            self.cache.write(address, wordsToBytes(array.array(WORD_TYPECODES[32], [value])))
+
+    def writeMemory(self, wordLen, address, data, chunkSize=0x10000, inFlight=4):
+        """Write data (see toWords()) as words of wordLen bits starting at
+        address. The words are sent in write_memory commands of chunkSize
+        bytes, inFlight of them pipelined, so no Tcl list bigger than a chunk
+        is ever built. Large writes go through loadImage() instead where
+        OpenOCD can open the file, see loadImageThreshold, falling back to
+        chunks if load_image fails."""
+        words = toWords(data, wordLen)
+        wordBytes = words.itemsize
+        if chunkSize % wordBytes:
+            raise ValueError("chunkSize must be a multiple of %d" % wordBytes)
+        if (self.loadImageThreshold is not None and len(words) * wordBytes >= self.loadImageThreshold
+                and self._sharesFiles()):
+            try:
+                self.loadImage(address, wordsToBytes(words))
+                return
+            except OpenOcdError:
+                # Write it in chunks, which also reports any real write error
+                pass
+
+        n = chunkSize // wordBytes
+        maxInFlight, self.maxInFlight = self.maxInFlight, inFlight
+        futures = []
+        try:
+            for offset in range(0, len(words), n):
+                futures.append(self._submit("write_memory 0x%x %d {%s}" % (
+                        address + offset * wordBytes, wordLen,
+                        " ".join(map("0x%x".__mod__, words[offset:offset + n]))),
+                        cacheSafe=True))
+        finally:
+            self.flush()
+            self.maxInFlight = maxInFlight
+        # write_memory only has a result if it failed
+        error = next(filter(None, (future.result() for future in futures)), None)
+        if self.cache is not None:
+            # After a failed chunk, memory contents are unknown
+            if error:
+                self.cache.clear()
+            else:
+                self.cache.write(address, wordsToBytes(words))
+        if error:
+            raise OpenOcdError(error)
+
+    def loadImage(self, address, data):
+        """Write the bytes data to target memory at address by staging them
+        in a temporary file for load_image. OpenOCD must be able to open the
+        file, see _sharesFiles()."""
+        fd, path = tempfile.mkstemp(prefix="ocd_rpc_", suffix=".bin")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            output = self._sendCacheSafe("load_image {%s} 0x%x bin" % (path, address))
+        finally:
+            os.unlink(path)
+        if "downloaded %d bytes" % len(data) not in output:
+            if self.cache is not None:
+                self.cache.clear()
+            raise OpenOcdError(output)
+        if self.cache is not None:
+            self.cache.write(address, data)
+
+    def _sharesFiles(self):
+        """Whether OpenOCD can open the temporary files this client writes.
+        A loopback address is not enough, OpenOCD may be port forwarded from
+        another machine, so OpenOCD is asked to find a new file, once per
+        connection."""
+        if self.filesShared is None:
+            fd, path = tempfile.mkstemp(prefix="ocd_rpc_")
+            os.close(fd)
+            try:
+                self.filesShared = self._sendCacheSafe("find {%s}" % path).strip() == path
+            finally:
+                os.unlink(path)
+        return self.filesShared
+
+class OpenOcdPool:
+    """Thread-safe pool of up to size connections to one Tcl RPC server.
+
+    with pool.connection() as ocd:
+        ocd.send("halt")
+
+    Connections are reused, most recently used first. One that was idle for
+    more than healthCheckAfter seconds is checked with a round trip before
+    it is handed out, and one that raised anything but OpenOcdError is
+    closed rather than returned, as its reply stream may be out of step.
+    Caches (OpenOcd.cache) are per connection and do not see each other's
+    writes."""
+    def __init__(self, tclRpcIp="127.0.0.1", tclRpcPort=6666, size=4, verbose=False):
+        self.tclRpcIp = tclRpcIp
+        self.tclRpcPort = tclRpcPort
+        self.size = size
+        self.verbose = verbose
+        self.healthCheckAfter = 10.0
+        self.healthCheckTimeout = 2.0
+        # Stripes of readMemory()/writeMemory() are at least this many bytes
+        self.minStripe = 0x10000
+
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def acquire(self, timeout=None):
+        """Take a connection from the pool, opening one if none is idle.
+        Wait up to timeout seconds (forever if None) for one to be free."""
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError("no free OpenOCD connection")
+        try:
+            while True:
+                try:
+                    ocd, lastUsed = self.idle.get_nowait()
+                except queue.Empty:
+                    ocd = OpenOcd(self.verbose)
+                    ocd.tclRpcIp = self.tclRpcIp
+                    ocd.tclRpcPort = self.tclRpcPort
+                    ocd.connect()
+                    return ocd
+                if time.monotonic() - lastUsed < self.healthCheckAfter or self._healthy(ocd):
+                    return ocd
+                ocd.sock.close()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, ocd, broken=False):
+        """Return a connection to the pool, or close it if broken."""
+        try:
+            if not broken:
+                ocd.flush()
+                self.idle.put((ocd, time.monotonic()))
+                return
+        except (OSError, OpenOcdError):
+            pass
+        finally:
+            self.slots.release()
+        ocd.sock.close()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        ocd = self.acquire(timeout)
+        try:
+            yield ocd
+        except OpenOcdError:
+            self.release(ocd)
+            raise
+        except BaseException:
+            self.release(ocd, broken=True)
+            raise
+        self.release(ocd)
+
+    def close(self):
+        """Close the idle connections."""
+        while True:
+            try:
+                ocd, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ocd.disconnect()
+            except OSError:
+                pass
+
+    def _healthy(self, ocd):
+        try:
+            ocd.sock.settimeout(self.healthCheckTimeout)
+            ocd.send("echo")
+            ocd.sock.settimeout(None)
+            return True
+        except OSError:
+            return False
+
+    def _stripes(self, size, align):
+        """Split size bytes into (start, end) stripes of multiples of align
+        bytes, one per connection but none smaller than minStripe."""
+        if size == 0:
+            return []
+        count = max(1, min(self.size, size // max(self.minStripe, 1)))
+        step = -(-size // count // align) * align
+        return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+    def _striped(self, operation, stripes):
+        """Run operation(ocd, start, end) for every stripe on its own pooled
+        connection, concurrently. Return the results in order."""
+        def run(stripe):
+            with self.connection() as ocd:
+                return operation(ocd, *stripe)
+        if len(stripes) <= 1:
+            return [run(stripe) for stripe in stripes]
+        with concurrent.futures.ThreadPoolExecutor(len(stripes)) as executor:
+            return list(executor.map(run, stripes))
+
+    def readMemory(self, wordLen, address, n):
+        """Read n words of wordLen bits like OpenOcd.readMemory(), but of any
+        size: the range is split into stripes read concurrently, each in
+        pipelined read_memory chunks on its own connection."""
+        wordBytes = wordLen // 8
+        data = self._striped(lambda ocd, start, end: ocd._readBytes(
+                address + start, end - start, wordLen=wordLen), self._stripes(n * wordBytes, wordBytes))
+        return bytesToWords(b"".join(data), wordLen)
 
     def writeMemory(self, wordLen, address, data):
-        data = "{" + ' '.join(['0x%x' % x for x in data]) + "}"
-        self.send("write_memory 0x%x %d %s" % (address, wordLen, data))
+        """Write data like OpenOcd.writeMemory(), striped like readMemory()."""
+        words = toWords(data, wordLen)
+        wordBytes = words.itemsize
+        self._striped(lambda ocd, start, end: ocd.writeMemory(
+                wordLen, address + start, words[start // wordBytes:end // wordBytes]),
+                self._stripes(len(words) * wordBytes, wordBytes))
 
 if __name__ == "__main__":
 
@@ -136,7 +1129,7 @@ if __name__ == "__main__":
         read = ocd.readMemory(wordlen, addr, n)
         show("memory (before):", list(map(hexify, read)))
 
-        ocd.writeMemory(wordlen, addr, n, data)
+        ocd.writeMemory(wordlen, addr, data)
 
         read = ocd.readMemory(wordlen, addr, n)
         show("memory  (after):", list(map(hexify, read)))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+End to end benchmark of the socket DMI stack without hardware.
+
+Starts dmi_socket_responder.py and an OpenOCD using the socket transport
+(src/jtag/riscv_socket_dmi.c), drives standard workloads through the OpenOcd
+Tcl RPC client in contrib/rpc_examples and writes a JSON report with, per
+workload, operations per second, latency percentiles and the DMI reads and
+writes each operation cost (counted by the simulator, see --stats-port), so
+a change to any of the three layers can be measured locally.
+
+Example:
+./dmi_benchmark.py --openocd ../src/openocd -o before.json
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, "contrib", "rpc_examples"))
+
+from ocd_rpc_example import OpenOcd
+
+RESPONDER = os.path.join(HERE, "dmi_socket_responder.py")
+
+# OpenOCD configuration for the socket transport. The transport can only be
+# selected once a target exists, so the target is created first. Its host and
+# port commands need the DTM driver, which only exists once init has run and
+# has already examined the target, so the simulator must listen where the
+# transport connects by default.
+OPENOCD_CONFIG = """\
+adapter driver riscv_dtm
+target create riscv.cpu riscv
+transport select socket
+init
+"""
+SOCKET_DMI_HOSTS = ("127.0.0.1", "localhost")
+SOCKET_DMI_PORT = 5555
+
+GPR_NAMES = ("zero ra sp gp tp t0 t1 t2 fp s1 a0 a1 a2 a3 a4 a5 a6 a7 "
+             "s2 s3 s4 s5 s6 s7 s8 s9 s10 s11 t3 t4 t5 t6").split()
+
+# read_memory/write_memory transfer sizes in bytes
+MEMORY_SIZES = (4, 64, 1024, 16384, 65536)
+
+STARTUP_TIMEOUT = 10
+
+
+def wait_for_port(host, port, process, log_path):
+    """Waits until something accepts connections on port, failing early if
+    the process that should listen there exits."""
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with {process.returncode}, see {log_path}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"nothing listening on {host}:{port}, see {log_path}")
+            time.sleep(0.1)
+
+def start_process(args, log_path):
+    with open(log_path, "wb") as log:
+        return subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT)
+
+def stop_process(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def dmi_counts(host, stats_port):
+    """Returns the simulator's DMI request counts so far."""
+    with socket.create_connection((host, stats_port)) as s:
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = s.recv(256)
+            if not data:
+                break
+            reply += data
+    return json.loads(reply)
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def run_workload(operation, counts, min_time, min_ops, bytes_per_op=0):
+    """Runs operation repeatedly, for at least min_time seconds and min_ops
+    times, after one warm up call. Returns its statistics."""
+    operation()
+    before = counts()
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < min_ops or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    after = counts()
+
+    ops = len(latencies)
+    latencies.sort()
+    result = {
+        "ops": ops,
+        "seconds": elapsed,
+        "ops_per_sec": ops / elapsed,
+        "latency_us": {
+            "min": latencies[0] * 1e6,
+            "p50": percentile(latencies, 0.5) * 1e6,
+            "p99": percentile(latencies, 0.99) * 1e6,
+            "max": latencies[-1] * 1e6,
+        },
+        "dmi_reads_per_op": (after["reads"] - before["reads"]) / ops,
+        "dmi_writes_per_op": (after["writes"] - before["writes"]) / ops,
+    }
+    result["dmi_ops_per_op"] = result["dmi_reads_per_op"] + result["dmi_writes_per_op"]
+    if bytes_per_op:
+        result["bytes_per_op"] = bytes_per_op
+        result["bytes_per_sec"] = bytes_per_op * ops / elapsed
+    return result
+
+def workloads(ocd, address, sizes):
+    """Yields (name, operation, bytes per operation) for every workload."""
+
+    # The simulator's dmstatus follows a script rather than haltreq and
+    # resumereq, so this times the request path, not a real hart
+    def halt_resume():
+        ocd.send("halt")
+        ocd.send("resume")
+    yield "halt_resume", halt_resume, 0
+
+    def gpr_dump():
+        # Read the target each time, not the client's or OpenOCD's cache
+        ocd.read_registers(GPR_NAMES, force=True)
+    yield "gpr_dump", gpr_dump, 0
+
+    for size in sizes:
+        words = max(1, size // 4)
+        yield (f"read_memory_{size}", lambda words=words: ocd.readMemory(32, address, words),
+               words * 4)
+    for size in sizes:
+        words = max(1, size // 4)
+        data = [(0x01020304 * i) & 0xFFFFFFFF for i in range(words)]
+        yield (f"write_memory_{size}", lambda data=data: ocd.writeMemory(32, address, data),
+               words * 4)
+
+def run_benchmark(args, counts):
+    results = {}
+    ocd = OpenOcd()
+    ocd.tclRpcIp = args.host
+    ocd.tclRpcPort = args.tcl_port
+    # Measure write_memory itself, not the load_image shortcut
+    ocd.loadImageThreshold = None
+    with ocd:
+        for name, operation, bytes_per_op in workloads(ocd, args.address, args.sizes):
+            if args.workload and name not in args.workload:
+                continue
+            if name != "halt_resume":
+                ocd.send("halt")
+            try:
+                result = run_workload(operation, counts, args.min_time, args.min_ops, bytes_per_op)
+                if name == "gpr_dump":
+                    result["registers"] = len(ocd.read_registers(GPR_NAMES))
+            except Exception as e:
+                result = {"error": str(e)}
+            results[name] = result
+            if "error" in result:
+                print(f"{name}: failed: {result['error']}")
+            else:
+                print(f"{name}: {result['ops_per_sec']:.1f} ops/s, "
+                      f"{result['dmi_ops_per_op']:.1f} DMI ops/op")
+    return results
+
+def main(args):
+    parser = argparse.ArgumentParser(
+            description='Benchmark OpenOCD over the socket DMI transport against '
+            'dmi_socket_responder.py and write a JSON report.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--openocd', default='openocd', help='OpenOCD binary')
+    parser.add_argument('--openocd-config',
+            help='OpenOCD configuration to use instead of the generated one; it '
+            'must select the socket transport and connect to --dmi-port')
+    parser.add_argument('--attach', action='store_true',
+            help='use an OpenOCD and simulator that are already running instead '
+            'of starting them; the simulator must have been started with --stats-port')
+    parser.add_argument('--host', default='127.0.0.1', help='host everything runs on')
+    parser.add_argument('--dmi-port', type=int, default=SOCKET_DMI_PORT, help='simulator DMI port')
+    parser.add_argument('--stats-port', type=int, default=5556, help='simulator statistics port')
+    parser.add_argument('--tcl-port', type=int, default=6666, help='OpenOCD Tcl RPC port')
+    parser.add_argument('--address', type=lambda text: int(text, 0), default=0x80000000,
+            help='target memory address the memory workloads use')
+    parser.add_argument('--sizes', type=int, nargs='+', default=MEMORY_SIZES,
+            help='read_memory/write_memory transfer sizes in bytes')
+    parser.add_argument('--workload', action='append',
+            help='only run this workload (e.g. gpr_dump, read_memory_1024); may be repeated')
+    parser.add_argument('--min-time', type=float, default=2.0,
+            help='seconds to run each workload for, at least')
+    parser.add_argument('--min-ops', type=int, default=10,
+            help='operations to run per workload, at least')
+    parser.add_argument('-o', '--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(args)
+    if (not args.attach and not args.openocd_config and
+            (args.host not in SOCKET_DMI_HOSTS or args.dmi_port != SOCKET_DMI_PORT)):
+        parser.error(f"the generated OpenOCD configuration only reaches a simulator on "
+                f"127.0.0.1:{SOCKET_DMI_PORT}, use --openocd-config for another address")
+
+    processes = []
+    log_dir = tempfile.mkdtemp(prefix="dmi_benchmark_")
+    try:
+        if not args.attach:
+            log_path = os.path.join(log_dir, "simulator.log")
+            simulator = start_process([sys.executable, RESPONDER, '--host', args.host,
+                    '--port', str(args.dmi_port), '--stats-port', str(args.stats_port)], log_path)
+            processes.append(simulator)
+            wait_for_port(args.host, args.stats_port, simulator, log_path)
+
+            config = args.openocd_config
+            if not config:
+                config = os.path.join(log_dir, "socket_dmi.cfg")
+                with open(config, "w") as f:
+                    f.write(OPENOCD_CONFIG.format(host=args.host, dmi_port=args.dmi_port))
+            log_path = os.path.join(log_dir, "openocd.log")
+            openocd = start_process([args.openocd, '-c', f'tcl port {args.tcl_port}',
+                    '-c', 'gdb port disabled', '-c', 'telnet port disabled',
+                    '-f', config], log_path)
+            processes.append(openocd)
+            wait_for_port(args.host, args.tcl_port, openocd, log_path)
+
+        results = run_benchmark(args, lambda: dmi_counts(args.host, args.stats_port))
+    finally:
+        for process in reversed(processes):
+            stop_process(process)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": socket.gethostname(),
+        "python": sys.version.split()[0],
+        "openocd": None if args.attach else args.openocd,
+        "logs": None if args.attach else log_dir,
+        "min_time": args.min_time,
+        "address": args.address,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    else:
+        print(json.dumps(report, indent=2))
+    return 1 if any("error" in result for result in results.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
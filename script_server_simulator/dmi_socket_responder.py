@@ -1,9 +1,16 @@
 import socket
 import struct
+import sys
 import time
 # import ipdb
-import binascii
 import threading
+import argparse
+import random
+import collections
+import array
+import functools
+import json
+import mmap
 
 HOST = 'localhost'
 PORT = 5555
@@ -16,14 +23,199 @@ WRITE_COMMAND = 0x01
 RESPONSE_OK = 0x00
 RESPONSE_ERROR = 0x01
 
+# Frame layout, must match src/jtag/riscv_socket_dmi.c. All fields are big endian.
+#   read:  [READ_COMMAND][address (4)][data_length (1)][sequence (1)][reserved (3), zero]
+#   write: [WRITE_COMMAND][address (4)][data_length (1)][sequence (1)][data (4)]
+# Every request is answered with [sequence][response code][data (4)], the data
+# is 0 for a write. A request with the sequence number of the one before it was
+# sent again because its reply was late, it is answered again but not run again.
+FRAME_HEADER_LENGTH = 7
+READ_FRAME_LENGTH = 10
+WRITE_FRAME_LENGTH = 11
+DATA_LENGTH = 4
+
       
 # --- Simulated Register State ---
 NUM_GPRS = 32  # 32 general-purpose registers in RISC-V
 
-gprs = [0] * NUM_GPRS
+DCSR_RESET_VALUE = 0x40000003
+
+# --- Simulated Memory ---
+PAGE_SIZE = 4096
+
+
+class BaseImage:
+    """Read-only memory image (e.g. firmware) mapped from a file at a fixed
+    address. One instance is shared by all sessions, the OS page cache holds
+    the only copy of its contents."""
+
+    def __init__(self, path, address=0):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = address
+        self.end = address + len(self.data)
+
+    def read_into(self, out, pos, address, length):
+        """Copy the part of [address, address + length) covered by the image
+        into out[pos:]."""
+        start = max(address, self.start)
+        end = min(address + length, self.end)
+        if start < end:
+            out[pos + start - address:pos + end - address] = self.data[start - self.start:end - self.start]
+
+
+class SparseMemory:
+    """Byte addressable memory, allocated a page at a time on first write.
+
+    Unwritten memory reads from the shared base image if there is one, and
+    as zero otherwise. The first write to a page copies it out of the base
+    image, so only pages a session touched cost memory."""
+
+    def __init__(self, base=None):
+        self.base = base
+        self.pages = {}
 
-dcsr = 0x40000003
-dpc = 0x00000000
+    def read(self, address, length):
+        out = bytearray(length)
+        pos = 0
+        while pos < length:
+            page, offset = divmod(address + pos, PAGE_SIZE)
+            n = min(PAGE_SIZE - offset, length - pos)
+            data = self.pages.get(page)
+            if data is not None:
+                out[pos:pos + n] = data[offset:offset + n]
+            elif self.base is not None:
+                self.base.read_into(out, pos, address + pos, n)
+            pos += n
+        return bytes(out)
+
+    def write(self, address, data):
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            page, offset = divmod(address + pos, PAGE_SIZE)
+            n = min(PAGE_SIZE - offset, len(data) - pos)
+            buf = self.pages.get(page)
+            if buf is None:
+                buf = self.pages[page] = bytearray(PAGE_SIZE)
+                if self.base is not None:
+                    self.base.read_into(buf, 0, page * PAGE_SIZE, PAGE_SIZE)
+            buf[offset:offset + n] = data[pos:pos + n]
+            pos += n
+
+# --- Memory Access Coverage ---
+COVERAGE_BLOCK_PAGES = 1024  # pages per counter block, i.e. 4 MiB of address space
+
+
+class AccessCoverage:
+    """Per-page counters of the memory accesses OpenOCD makes through the
+    system bus and abstract memory commands.
+
+    Counters are kept in array blocks of COVERAGE_BLOCK_PAGES pages each,
+    allocated when a page in the block is first touched. Recording an access
+    costs a dict lookup and two array increments, and memory use stays at a
+    few KiB per touched 4 MiB of address space. Sessions on different
+    connections record into the same counters, under a lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # block number -> (read counts, write counts, bytes read)
+        self.blocks = {}
+
+    def _block(self, block):
+        counters = self.blocks.get(block)
+        if counters is None:
+            counters = self.blocks[block] = (
+                array.array('I', bytes(4 * COVERAGE_BLOCK_PAGES)),
+                array.array('I', bytes(4 * COVERAGE_BLOCK_PAGES)),
+                array.array('Q', bytes(8 * COVERAGE_BLOCK_PAGES)))
+        return counters
+
+    def record(self, address, size, write):
+        page = address // PAGE_SIZE
+        last = (address + size - 1) // PAGE_SIZE
+        with self.lock:
+            while True:
+                block, index = divmod(page, COVERAGE_BLOCK_PAGES)
+                reads, writes, read_bytes = self._block(block)
+                if write:
+                    writes[index] += 1
+                else:
+                    reads[index] += 1
+                    end = min(address + size, (page + 1) * PAGE_SIZE)
+                    read_bytes[index] += end - max(address, page * PAGE_SIZE)
+                if page == last:
+                    break
+                page += 1
+
+    def pages(self):
+        """Yield (page, reads, writes, bytes read) for every touched page, in
+        address order."""
+        with self.lock:
+            # A copy, so other sessions can go on recording meanwhile
+            blocks = {block: tuple(array.array(c.typecode, c) for c in counters)
+                    for block, counters in self.blocks.items()}
+        for block in sorted(blocks):
+            reads, writes, read_bytes = blocks[block]
+            base = block * COVERAGE_BLOCK_PAGES
+            for index in range(COVERAGE_BLOCK_PAGES):
+                if reads[index] or writes[index]:
+                    yield base + index, reads[index], writes[index], read_bytes[index]
+
+    def summary(self, top=10):
+        touched = list(self.pages())
+        lines = [f"Memory access coverage: {len(touched)} pages of {PAGE_SIZE} bytes touched"]
+        # Runs of consecutive pages, so a firmware load reads as one line
+        run = None
+        runs = []
+        for page, reads, writes, read_bytes in touched:
+            if run and run[1] + 1 == page:
+                run[1] = page
+                run[2] += reads
+                run[3] += writes
+            else:
+                run = [page, page, reads, writes]
+                runs.append(run)
+        for first, last, reads, writes in runs:
+            lines.append(f"  0x{first * PAGE_SIZE:08X}-0x{(last + 1) * PAGE_SIZE - 1:08X}: "
+                         f"{last - first + 1} pages, {reads} reads, {writes} writes")
+        reread = sorted((p for p in touched if p[3] > PAGE_SIZE), key=lambda p: -p[3])[:top]
+        if reread:
+            lines.append("  Most re-read pages (bytes read / page size):")
+            for page, reads, writes, read_bytes in reread:
+                lines.append(f"    0x{page * PAGE_SIZE:08X}: {read_bytes / PAGE_SIZE:.1f}x "
+                             f"in {reads} reads")
+        return "\n".join(lines)
+
+
+coverage = None
+
+# --- DMI Request Statistics ---
+
+
+class DmiStats:
+    """Counts of the DMI requests served over all DMI connections, so a
+    benchmark can tell how many DMI operations an OpenOCD command costs.
+    Served as one JSON object per connection on --stats-port."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+
+    def record(self, command):
+        with self.lock:
+            if command == READ_COMMAND:
+                self.reads += 1
+            else:
+                self.writes += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"reads": self.reads, "writes": self.writes}
+
+
+dmi_stats = None
 
 
 
@@ -39,18 +231,15 @@ DMI_DATA0 = 0x04  # Data register 0 (for abstract commands)
 DMI_DATA1 = 0x05  # Data register 1 (for abstract commands)
 DMI_PROGBUF0 = 0x20  # Program Buffer 0 (for program buffer access)
 DMI_SBCS = 0x38 # System Bus Access Control and Status
+DMI_SBADDRESS0 = 0x39 # System Bus Address 31:0
+DMI_SBDATA0 = 0x3C # System Bus Data 31:0
 DMI_DCSR = 0x7B0
 DMI_MSTATUS = 0x300
 
 DMI_DTMCS_OFFSET_DEBUG = 0x0000
 
-# This needs to be changed, a temp hack to reply to the OpenOCD, probably some issue with 
-# the kernel buffer, but it works somehow. Some clearing of the buffer is needed, or 
-# better managing of the messages, either by size, or by some delimiter of the message.
-DMI_TEST = 0x10040000
-
-dmi_mem = {
-    DMI_TEST: 0x0041,
+# Register values a new session starts with
+DMI_RESET_VALUES = {
     DMI_DTMCS_OFFSET_DEBUG: 0x0000, # 0x00000000 is the default value for all registers, 0x0000 is the address offset for the DTMCS register
     DMI_DMCONTROL: 0x0001,  # Initially, let's say the hart is running
     DMI_DMSTATUS: 0x0202,  # Indicate all harts are running, version 0.13 (version=2)
@@ -61,125 +250,543 @@ dmi_mem = {
     DMI_DATA0: 0x0000,
     DMI_DATA1: 0x0000,
     DMI_PROGBUF0: 0x0000,
-    DMI_SBCS: 0x0000,
+    DMI_SBCS: 0x0000,  # Configuration and error bits only, see SBCS_CAPABILITIES
+    DMI_SBADDRESS0: 0x0000,
+    DMI_SBDATA0: 0x0000,
     DMI_DCSR: 0x00000000,
     DMI_MSTATUS: 0x00000000,
 }
 
-# This is a hack to clear the kernel buffer
-# It is necessary because the kernel buffer is not cleared by the socket
-# and it can cause problems with the DMI protocol  in some cases, so better be safe
-def clear_kernel_buffer(sock):
-    sock.setblocking(False)
-    
+# --- Fault Injection ---
+# Deterministic (seeded) injection of link and debug module errors, so the
+# retry and backoff paths in OpenOCD can be exercised and timed without
+# hardware. Rules are given on the command line, see parse_fault_rule().
+FAULT_BUSY = "busy"                # abstractcs.busy set on a read
+FAULT_CMDERR = "cmderr"            # abstract command fails, cmderr latched until W1C
+FAULT_SBBUSYERROR = "sbbusyerror"  # sbcs.sbbusyerror latched until W1C
+FAULT_DROP = "drop"                # request is lost before it runs, OpenOCD times out and sends it again
+FAULT_DELAY = "delay"              # reply is sent after a delay
+
+ABSTRACTCS_BUSY = 1 << 12
+ABSTRACTCS_CMDERR_SHIFT = 8
+ABSTRACTCS_CMDERR_MASK = 0x7 << ABSTRACTCS_CMDERR_SHIFT
+# Read-only fields of abstractcs: progbufsize 2, datacount 2
+ABSTRACTCS_CAPABILITIES = 0x2000002
+CMDERR_BUSY = 1
+SBCS_SBBUSYERROR = 1 << 22
+
+# Addresses a rule applies to when none is given explicitly, None means any address.
+FAULT_DEFAULT_ADDRESSES = {
+    FAULT_BUSY: (DMI_ABSTRACTCS,),
+    FAULT_CMDERR: (DMI_COMMAND,),
+    FAULT_SBBUSYERROR: (DMI_SBADDRESS0, DMI_SBDATA0),
+    FAULT_DROP: None,
+    FAULT_DELAY: None,
+}
+
+# Default argument of a rule: the cmderr code, or the delay in seconds.
+FAULT_DEFAULT_ARGS = {
+    FAULT_CMDERR: CMDERR_BUSY,
+    FAULT_DELAY: 0.01,
+}
+
+
+class FaultRule:
+    def __init__(self, kind, rate, arg=None, addresses=None):
+        if kind not in FAULT_DEFAULT_ADDRESSES:
+            raise ValueError(f"unknown fault kind {kind!r}")
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError(f"fault rate {rate} is not in [0, 1]")
+        self.kind = kind
+        self.rate = rate
+        self.arg = FAULT_DEFAULT_ARGS.get(kind) if arg is None else arg
+        self.addresses = FAULT_DEFAULT_ADDRESSES[kind] if addresses is None else addresses
+
+    def matches(self, address):
+        return self.addresses is None or address in self.addresses
+
+    def __repr__(self):
+        where = "any" if self.addresses is None else ",".join(f"0x{a:02X}" for a in self.addresses)
+        return f"FaultRule({self.kind}, rate={self.rate}, arg={self.arg}, addresses={where})"
+
+
+def parse_fault_rule(text):
+    """Parse a rule of the form KIND=RATE[:ARG][@ADDR[,ADDR...]], e.g.
+    'busy=0.2', 'cmderr=0.05:3', 'delay=0.1:0.02@0x11' or 'drop=0.001'."""
+    addresses = None
+    if "@" in text:
+        text, where = text.split("@", 1)
+        addresses = tuple(int(a, 0) for a in where.split(","))
+    kind, _, value = text.partition("=")
+    rate, _, arg = value.partition(":")
+    if arg:
+        arg = float(arg) if kind == FAULT_DELAY else int(arg, 0)
+    else:
+        arg = None
+    return FaultRule(kind, float(rate), arg, addresses)
+
+
+class FaultInjector:
+    """Decides, per DMI access, which faults to inject. All decisions come
+    from one seeded random generator, so the same seed and the same sequence
+    of DMI accesses always produce the same faults."""
+
+    def __init__(self, rules=(), seed=0):
+        self.rules = list(rules)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.counts = collections.Counter()
+        # Sticky error state, cleared by OpenOCD writing 1s (W1C)
+        self.cmderr = 0
+        self.sbbusyerror = False
+
+    def fire(self, kind, address):
+        """Return the first rule of `kind` matching `address` that fires, or None."""
+        for rule in self.rules:
+            if rule.kind == kind and rule.matches(address) and self.rng.random() < rule.rate:
+                self.counts[kind] += 1
+                return rule
+        return None
+
+    def on_read(self, address, data):
+        """Return the read value of `address` with any injected error bits set."""
+        if address == DMI_ABSTRACTCS:
+            if self.fire(FAULT_BUSY, address):
+                data |= ABSTRACTCS_BUSY
+            if self.cmderr:
+                data = (data & ~ABSTRACTCS_CMDERR_MASK) | (self.cmderr << ABSTRACTCS_CMDERR_SHIFT)
+        elif address == DMI_SBCS:
+            if self.sbbusyerror:
+                data |= SBCS_SBBUSYERROR
+        if self.fire(FAULT_SBBUSYERROR, address):
+            self.sbbusyerror = True
+        return data
+
+    def on_write(self, address, data):
+        """Track W1C clearing of the sticky error bits. Return the cmderr to
+        report for an abstract command written to DMI_COMMAND, or None if no
+        error should be injected."""
+        if address == DMI_ABSTRACTCS and (data & ABSTRACTCS_CMDERR_MASK):
+            self.cmderr = 0
+        elif address == DMI_SBCS and (data & SBCS_SBBUSYERROR):
+            self.sbbusyerror = False
+        if self.fire(FAULT_SBBUSYERROR, address):
+            self.sbbusyerror = True
+        if self.cmderr and address == DMI_COMMAND:
+            # The debug module ignores commands while cmderr is set
+            return self.cmderr
+        rule = self.fire(FAULT_CMDERR, address)
+        if rule:
+            self.cmderr = rule.arg & 0x7
+            return self.cmderr
+        return None
+
+    def reply_delay(self, address):
+        """Return None if a request to access `address` must be dropped, as if
+        it never arrived, otherwise the number of seconds to wait before
+        sending its reply."""
+        if self.fire(FAULT_DROP, address):
+            return None
+        rule = self.fire(FAULT_DELAY, address)
+        return rule.arg if rule else 0.0
+
+    def summary(self):
+        lines = [f"Fault injection summary (seed {self.seed}):"]
+        for rule in self.rules:
+            lines.append(f"  {rule!r}")
+        for kind in FAULT_DEFAULT_ADDRESSES:
+            lines.append(f"  {kind:12s} injected {self.counts[kind]} times")
+        return "\n".join(lines)
+
+
+# --- Sessions ---
+class Session:
+    """Debug module and hart state of one client connection.
+
+    Sessions never share mutable state: memory is a copy-on-write overlay
+    over the shared read-only base image, so creating one copies a few dozen
+    register values and nothing else."""
+
+    def __init__(self, base=None, fault_rules=(), fault_seed=0):
+        self.dmi_mem = dict(DMI_RESET_VALUES)
+        self.gprs = [0] * NUM_GPRS
+        self.dcsr = DCSR_RESET_VALUE
+        self.dpc = 0x00000000
+        self.memory = SparseMemory(base)
+        self.faults = FaultInjector(fault_rules, fault_seed)
+        self.hart_state = "halted"
+        # COUNTERS, scripting the dmstatus/dmcontrol values seen by OpenOCD
+        self.dmi_status_counter = 0
+        self.dmi_dmcontrol_counter = 0
+        # (sequence, reply) of the last request run, to answer it again
+        self.last_reply = None
+
+
+def send_reply(session, conn, sequence, data, delay):
+    """Send the reply to request `sequence` after `delay` seconds, and keep
+    it in case the request is sent again."""
+    reply = struct.pack(">BBI", sequence, RESPONSE_OK, data)
+    session.last_reply = (sequence, reply)
+    if delay:
+        print(f"Fault injection: delaying reply to request {sequence} by {delay}s")
+        time.sleep(delay)
+    conn.sendall(reply)
+
+# --- System Bus Access ---
+SBCS_SBVERSION_1 = 1 << 29
+SBCS_SBREADONADDR = 1 << 20
+SBCS_SBACCESS_SHIFT = 17
+SBCS_SBACCESS_MASK = 0x7 << SBCS_SBACCESS_SHIFT
+SBCS_SBAUTOINCREMENT = 1 << 16
+SBCS_SBREADONDATA = 1 << 15
+SBCS_SBERROR_SHIFT = 12
+SBCS_SBERROR_MASK = 0x7 << SBCS_SBERROR_SHIFT
+SBCS_SBERROR_SIZE = 4
+SBCS_SBASIZE_32 = 32 << 5
+SBCS_SBACCESS_8_16_32 = 0x7
+SBCS_CONFIG_MASK = SBCS_SBREADONADDR | SBCS_SBACCESS_MASK | SBCS_SBAUTOINCREMENT | SBCS_SBREADONDATA
+# Read-only fields of sbcs: version 1, 32-bit addresses, 8/16/32-bit accesses
+SBCS_CAPABILITIES = SBCS_SBVERSION_1 | SBCS_SBASIZE_32 | SBCS_SBACCESS_8_16_32
+
+
+def bus_read(session, address, size):
+    if coverage:
+        coverage.record(address, size, False)
+    return int.from_bytes(session.memory.read(address, size), "little")
+
+
+def bus_write(session, address, size, value):
+    if coverage:
+        coverage.record(address, size, True)
+    session.memory.write(address, (value & ((1 << (8 * size)) - 1)).to_bytes(size, "little"))
+
+
+def system_bus_access(session, write):
+    """Perform one system bus access as configured in sbcs, at sbaddress0
+    and from/to sbdata0."""
+    dmi_mem = session.dmi_mem
+    sbcs = dmi_mem[DMI_SBCS]
+    if session.faults.sbbusyerror or sbcs & SBCS_SBERROR_MASK:
+        # Accesses are ignored until the error is cleared
+        return
+    sbaccess = (sbcs & SBCS_SBACCESS_MASK) >> SBCS_SBACCESS_SHIFT
+    if not (1 << sbaccess) & SBCS_SBACCESS_8_16_32:
+        dmi_mem[DMI_SBCS] |= SBCS_SBERROR_SIZE << SBCS_SBERROR_SHIFT
+        return
+    size = 1 << sbaccess
+    address = dmi_mem[DMI_SBADDRESS0]
+    if write:
+        bus_write(session, address, size, dmi_mem[DMI_SBDATA0])
+    else:
+        dmi_mem[DMI_SBDATA0] = bus_read(session, address, size)
+    if sbcs & SBCS_SBAUTOINCREMENT:
+        dmi_mem[DMI_SBADDRESS0] = (address + size) & 0xFFFFFFFF
+
+
+# --- GDB Remote Serial Protocol stub ---
+# A direct path from GDB to the simulated hart, bypassing OpenOCD, so the
+# latency of OpenOCD-mediated debugging can be compared against it.
+GDB_PACKET_SIZE = 0x4000
+GDB_REG_PC = 32  # x0..x31 are registers 0..31, pc follows them
+
+def build_target_xml():
+    """The built-in target description: x0..x31 and pc of an RV32 hart."""
+    regs = [f'<reg name="x{n}" bitsize="32" regnum="{n}"/>' for n in range(NUM_GPRS)]
+    regs.append(f'<reg name="pc" bitsize="32" regnum="{GDB_REG_PC}" type="code_ptr"/>')
+    return ('<?xml version="1.0"?>\n'
+            '<!DOCTYPE target SYSTEM "gdb-target.dtd">\n'
+            '<target version="1.0">\n'
+            '<architecture>riscv:rv32</architecture>\n'
+            '<feature name="org.gnu.gdb.riscv.cpu">\n'
+            + "\n".join(regs) +
+            '\n</feature>\n'
+            '</target>\n').encode()
+
+
+class TargetXml:
+    """target.xml, read and escaped for qXfer replies once. GDB asks for
+    chunks of whatever size suits it, so a table keyed by offset gives where
+    every byte of the content starts in the escaped content, and any request
+    is answered with a slice of that."""
+
+    def __init__(self, content):
+        self.content = content
+        escaped = bytearray()
+        self.starts = []
+        for offset in range(len(content)):
+            self.starts.append(len(escaped))
+            escaped += rsp_escape(content[offset:offset + 1])
+        self.starts.append(len(escaped))
+        self.escaped = bytes(escaped)
+
+    def read(self, offset, length):
+        end = min(offset + length, len(self.content))
+        offset = min(offset, end)
+        more = b"m" if end < len(self.content) else b"l"
+        return more + self.escaped[self.starts[offset]:self.starts[end]]
+
+
+def rsp_escape(data):
+    """Escape binary data for use in an RSP packet body."""
+    if not any(c in data for c in b"#$}*"):
+        return data
+    out = bytearray()
+    for c in data:
+        if c in b"#$}*":
+            out += bytes((0x7D, c ^ 0x20))
+        else:
+            out.append(c)
+    return bytes(out)
+
+
+def rsp_unescape(data):
+    """Undo rsp_escape() on the binary payload of an X packet."""
+    if b"}" not in data:
+        return data
+    out = bytearray()
+    escaped = False
+    for c in data:
+        if escaped:
+            out.append(c ^ 0x20)
+            escaped = False
+        elif c == 0x7D:
+            escaped = True
+        else:
+            out.append(c)
+    return bytes(out)
+
+
+def rsp_frame(body):
+    return b"$" + body + b"#%02x" % (sum(body) & 0xFF)
+
+
+def gdb_stop_reply():
+    return b"S05"
+
+
+def gdb_read_registers(session):
+    return struct.pack(f"<{NUM_GPRS + 1}I", *session.gprs, session.dpc).hex().encode()
+
+
+def gdb_write_registers(session, hexdata):
+    """Returns False if hexdata is not the values of all registers."""
+    try:
+        values = struct.unpack(f"<{NUM_GPRS + 1}I", bytes.fromhex(hexdata.decode()))
+    except (ValueError, struct.error):
+        return False
+    session.gprs[1:] = values[1:NUM_GPRS]
+    session.dpc = values[GDB_REG_PC]
+    return True
+
+
+def gdb_read_register(session, regno):
+    if regno < NUM_GPRS:
+        value = session.gprs[regno]
+    elif regno == GDB_REG_PC:
+        value = session.dpc
+    else:
+        return None
+    return struct.pack("<I", value & 0xFFFFFFFF).hex().encode()
+
+
+def gdb_write_register(session, regno, hexvalue):
+    try:
+        value = struct.unpack("<I", bytes.fromhex(hexvalue.decode()))[0]
+    except (ValueError, struct.error):
+        return False
+    if regno == 0:
+        pass  # x0 is hardwired to zero
+    elif regno < NUM_GPRS:
+        session.gprs[regno] = value
+    elif regno == GDB_REG_PC:
+        session.dpc = value
+    else:
+        return False
+    return True
+
+
+def gdb_resume(session, action):
+    """Resume the hart for a c/s style action, returns the stop reply to send
+    right away or None if the hart keeps running until GDB interrupts it."""
+    if action in (b"s", b"S"):
+        # Simulate stepping one instruction
+        session.dpc = (session.dpc + 4) & 0xFFFFFFFF
+        session.hart_state = "halted"
+        return gdb_stop_reply()
+    session.hart_state = "running"
+    return None
+
+
+def handle_vcont(session, packet):
+    """vCont;ACTION[:THREAD]... The simulator has a single hart, so only the
+    first action matters."""
+    action = packet[len(b"vCont;"):].split(b";")[0].split(b":")[0]
+    return gdb_resume(session, action[:1])
+
+
+def handle_gdb_packet(session, packet, target_xml):
+    """Return the reply body for a packet, or None if there is no reply
+    until the hart stops."""
+    kind = packet[:1]
+    if kind == b"g":
+        return gdb_read_registers(session)
+    elif kind == b"G":
+        return b"OK" if gdb_write_registers(session, packet[1:]) else b"E01"
+    elif kind == b"p":
+        value = gdb_read_register(session, int(packet[1:], 16))
+        return value if value is not None else b"E01"
+    elif kind == b"P":
+        regno, _, value = packet[1:].partition(b"=")
+        return b"OK" if gdb_write_register(session, int(regno, 16), value) else b"E01"
+    elif kind == b"m":
+        address, length = packet[1:].split(b",")
+        return session.memory.read(int(address, 16), int(length, 16)).hex().encode()
+    elif kind == b"M":
+        header, data = packet[1:].split(b":", 1)
+        address, _ = header.split(b",")
+        session.memory.write(int(address, 16), bytes.fromhex(data.decode()))
+        return b"OK"
+    elif kind == b"X":
+        header, data = packet[1:].split(b":", 1)
+        address, length = header.split(b",")
+        data = rsp_unescape(data)
+        if len(data) != int(length, 16):
+            return b"E01"
+        session.memory.write(int(address, 16), data)
+        return b"OK"
+    elif kind == b"?":
+        return gdb_stop_reply()
+    elif kind in (b"c", b"s"):
+        return gdb_resume(session, kind)
+    elif packet.startswith(b"qSupported"):
+        return b"PacketSize=%x;qXfer:features:read+;vContSupported+;QStartNoAckMode+" % GDB_PACKET_SIZE
+    elif packet.startswith(b"qXfer:features:read:target.xml:"):
+        offset, length = packet[len(b"qXfer:features:read:target.xml:"):].split(b",")
+        return target_xml.read(int(offset, 16), int(length, 16))
+    elif packet == b"vCont?":
+        return b"vCont;c;C;s;S"
+    elif packet.startswith(b"vCont;"):
+        return handle_vcont(session, packet)
+    elif packet == b"qAttached":
+        return b"1"
+    elif packet == b"qC":
+        return b"QC1"
+    elif packet == b"qfThreadInfo":
+        return b"m1"
+    elif packet == b"qsThreadInfo":
+        return b"l"
+    elif kind == b"H" or packet.startswith(b"T"):
+        return b"OK"
+    elif kind == b"D":
+        return b"OK"
+    else:
+        print(f"Unhandled GDB packet: {packet[:64]!r}")
+        return b""  # Empty reply means unsupported
+
+
+def handle_gdb_connection(conn, target_xml, session):
+    """Handles GDB Remote Serial Protocol (RSP) packets."""
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    ack = True
+    buffer = b""
     try:
         while True:
-            data = sock.recv(4096)
+            data = conn.recv(GDB_PACKET_SIZE)
             if not data:
                 break
-    except BlockingIOError:
-        pass
+            buffer += data
+            while buffer:
+                if buffer[:1] in (b"+", b"-"):
+                    buffer = buffer[1:]
+                    continue
+                if buffer[:1] == b"\x03":
+                    # Interrupt from GDB while the hart is running
+                    buffer = buffer[1:]
+                    if session.hart_state == "running":
+                        session.hart_state = "halted"
+                        conn.sendall(rsp_frame(b"S02"))
+                    continue
+                start = buffer.find(b"$")
+                if start < 0:
+                    buffer = b""
+                    break
+                end = buffer.find(b"#", start)
+                if end < 0 or len(buffer) < end + 3:
+                    buffer = buffer[start:]
+                    break
+                packet = buffer[start + 1:end]
+                buffer = buffer[end + 3:]
+                if ack:
+                    conn.sendall(b"+")
+                if packet == b"QStartNoAckMode":
+                    conn.sendall(rsp_frame(b"OK"))
+                    ack = False
+                    continue
+                if packet == b"k":
+                    return
+                try:
+                    reply = handle_gdb_packet(session, packet, target_xml)
+                except (ValueError, struct.error):
+                    print(f"Malformed GDB packet: {packet[:64]!r}")
+                    reply = b"E01"
+                if reply is not None:
+                    conn.sendall(rsp_frame(reply))
+    except Exception as e:
+        print(f"GDB connection error: {e}")
     finally:
-        sock.setblocking(True)
-
-# def handle_gdb_packet(packet):
-#     if packet.startswith("qSupported"):
-#         return "PacketSize=4000;qXfer:features:read+;vContSupported+"
-#     elif packet == "vCont?":
-#         return "vCont;c;C;s;S"
-#     elif packet.startswith("qXfer:features:read:target.xml"):
-#         _, params = packet.split(":")
-#         parts = params.split(",")
-#         offset = int(parts[0], 16)
-#         length = int(parts[1], 16)
-        
-#         # Load your target.xml content
-#         with open("target.xml", "r") as f:
-#             xml_content = f.read()
-        
-#         # Return the requested chunk
-#         chunk = xml_content[offset:offset+length]
-#         more = "m" if (offset + length) < len(xml_content) else "l"
-#         return f"${more}{chunk}#00"
-#         # return handle_target_xml_request(packet)
-#     elif packet.startswith("vCont"):
-#         return handle_vcont(packet)
-#     else:
-#         print("Unhandled packet!!!")
-#         return ""  # Unhandled packets
-
-# hart_state = "halted"
-
-# def handle_vcont(packet):
-#     global hart_state
-#     if packet == "vCont;c":  # Continue
-#         hart_state = "running"
-#         return "OK"
-#     elif packet == "vCont;s":  # Step
-#         # Simulate stepping one instruction
-#         hart_state = "halted"
-#         return "S05"  # Signal a breakpoint (trap)
-
-# def handle_gdb_connection(conn):
-#     """Handles GDB Remote Serial Protocol (RSP) packets."""
-#     try:
-#         while True:
-#             packet = conn.recv(4096).decode().strip()
-#             if not packet:
-#                 break
-#             print(f"Received GDB packet: {packet}")
-
-#             # Handle packets like qSupported, vCont, etc.
-#             response = handle_gdb_packet(packet)
-#             if response:
-#                 conn.sendall(response.encode())
-#     except Exception as e:
-#         print(f"GDB connection error: {e}")
-#     finally:
-#         conn.close()
-
-# def start_gdb_server():
-#     """Starts a GDB server on port 3333."""
-#     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-#         s.bind(('localhost', 3333))
-#         s.listen()
-#         print("GDB server listening on port 3333")
-#         while True:
-#             conn, addr = s.accept()
-#             print(f"GDB connected from {addr}")
-#             threading.Thread(target=handle_gdb_connection, args=(conn,)).start()
-
-def handle_dmi_read(address, conn):
-    """Handles DMI read requests."""
-    # ipdb.set_trace()
+        conn.close()
 
-    # COUNTERS
-    if not hasattr(handle_dmi_read, "dmi_status_counter"):
-        handle_dmi_read.dmi_status_counter = [0]
-    if not hasattr(handle_dmi_read, "dmi_dmcontrol_counter"):
-        handle_dmi_read.dmi_dmcontrol_counter = [0]
+
+def start_gdb_server(host, port, target_xml, new_session):
+    """Starts a GDB server, serving one thread and session per connection."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen()
+        print(f"GDB server listening on {host}:{port}")
+        while True:
+            conn, addr = s.accept()
+            print(f"GDB connected from {addr}")
+            threading.Thread(target=handle_gdb_connection, args=(conn, target_xml, new_session()),
+                    daemon=True).start()
+
+def start_stats_server(host, port):
+    """Answers every connection with the DMI request counts as JSON."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen()
+        print(f"DMI statistics on {host}:{port}")
+        while True:
+            conn, addr = s.accept()
+            with conn:
+                conn.sendall(json.dumps(dmi_stats.snapshot()).encode() + b"\n")
+
+def handle_dmi_read(session, address):
+    """Handles DMI read requests, returns the value read."""
+    # ipdb.set_trace()
+    dmi_mem = session.dmi_mem
 
     if address in dmi_mem:
         data = dmi_mem[address]
         print(f"DMI Read: Addr=0x{address:02X}, Data=0x{data:08X}")
         # ipdb.set_trace()
         if address == DMI_DTMCS_OFFSET_DEBUG:
-            # clear_kernel_buffer(conn)
             data = 0x61
             print(f"  DTMCS offset debug: Returning: 0x{data:08X}")
 
         elif address == DMI_DMCONTROL:
-            print(f"******************** Counter DMI_CONTROL is: {handle_dmi_read.dmi_dmcontrol_counter[0]}")
-            if handle_dmi_read.dmi_dmcontrol_counter[0] == 2:
+            print(f"******************** Counter DMI_CONTROL is: {session.dmi_dmcontrol_counter}")
+            if session.dmi_dmcontrol_counter == 2:
                 data = 0x40  # Example: Set dmactive (bit 31) and dmireset (bit 0)
             else:
                 data = 0x41
-            handle_dmi_read.dmi_dmcontrol_counter[0] += 1
+            session.dmi_dmcontrol_counter += 1
             print(f"  DTMCONTROL read! Returning: 0x{data:08X}")
 
         elif address == DMI_ABSTRACTCS:
             print(f"Handling the {DMI_ABSTRACTCS} address")
-            data = 0x2000002
+            data = ABSTRACTCS_CAPABILITIES | dmi_mem[DMI_ABSTRACTCS]
 
         elif address == DMI_DMSTATUS:
             print(f"  DMI_DMSTATUS read! Current value: 0x{data:08X}")
@@ -223,12 +830,12 @@ def handle_dmi_read(address, conn):
                 ((allhavereset & 0x01) << 19) | \
                 ((impebreak & 0x03) << 20) | \
                 (0 << 31)  # bit 31 is fixed to 0
-            handle_dmi_read.dmi_status_counter[0] += 1
-            if handle_dmi_read.dmi_status_counter[0] == 0:
+            session.dmi_status_counter += 1
+            if session.dmi_status_counter == 0:
                 data = 0x400C82 # This is what spike simulator returns later when halting the hart
-            if handle_dmi_read.dmi_status_counter[0] >= 1 and handle_dmi_read.dmi_status_counter[0] < 10:
+            if session.dmi_status_counter >= 1 and session.dmi_status_counter < 10:
                 data = 0x400282
-            if handle_dmi_read.dmi_status_counter[0] > 10:
+            if session.dmi_status_counter > 10:
                 data = (0x2 & 0x0f) | \
                     ((0x0 & 0x01) << 4) | \
                     ((0x0 & 0x01) << 5) | \
@@ -249,22 +856,27 @@ def handle_dmi_read(address, conn):
                     ((0x0 & 0x03) << 20) | \
                     (0 << 31)  # bit 31 is fixed to 0
             print(f"  DMI_DMSTATUS read! Constructed value: 0x{data:08X}")
-        # Pack the 32-bit data only once:
-        response_data = struct.pack(">I", data) 
-        # Construct the response by concatenating status and data:
-        response = struct.pack(">B", RESPONSE_OK) + response_data
-        time.sleep(0.1)
-        print(f"Sending response: {response!r}")  # !r for printable representation
-        print(f"Response in hex: {binascii.hexlify(response)}")
-        conn.sendall(response)
+
+        elif address == DMI_SBCS:
+            data = SBCS_CAPABILITIES | dmi_mem[DMI_SBCS]
+
+        elif address == DMI_SBDATA0:
+            # data already holds the value, a read on data starts the next access
+            if dmi_mem[DMI_SBCS] & SBCS_SBREADONDATA:
+                system_bus_access(session, write=False)
+        data = session.faults.on_read(address, data)
+        print(f"Sending response: 0x{data:08X}")
         return data
     else:
-        print(f"DMI Read: Addr=0x{address:02X} - Address not found!")
-        return None
+        # Unimplemented debug module registers read as 0
+        print(f"DMI Read: Addr=0x{address:02X} - Address not found, reading as 0")
+        return 0
 
-def handle_dmi_write(address, data):
+def handle_dmi_write(session, address, data):
     print(f"DMI Write: Addr=0x{address:02X}, Data=0x{data:08X}")
     # ipdb.set_trace()
+    dmi_mem = session.dmi_mem
+    injected_cmderr = session.faults.on_write(address, data)
     if address == DMI_DMCONTROL:
         print(f"  DMI_DMCONTROL write! Data: 0x{data:08X}")
         # Implement basic DMCONTROL handling (e.g., halt, resume)
@@ -305,16 +917,40 @@ def handle_dmi_write(address, data):
         # Implement abstract command handling
         print(f"DMI_COMMAND 0x{DMI_COMMAND} address sets the data now to {data}.")
         dmi_mem[DMI_COMMAND] = data # Write data here
-        cmderr = execute_abstract_command(data)
-        dmi_mem[DMI_ABSTRACTCS] = (dmi_mem[DMI_ABSTRACTCS] & ~0x7) | cmderr
+        if injected_cmderr is not None:
+            print(f"Fault injection: abstract command fails with cmderr {injected_cmderr}")
+            return
+        if dmi_mem[DMI_ABSTRACTCS] & ABSTRACTCS_CMDERR_MASK:
+            print("  cmderr is set, command ignored")
+            return
+        cmderr = execute_abstract_command(session, data)
+        dmi_mem[DMI_ABSTRACTCS] |= cmderr << ABSTRACTCS_CMDERR_SHIFT
+
+    elif address == DMI_ABSTRACTCS:
+        # Only cmderr is writable, and it is W1C
+        dmi_mem[DMI_ABSTRACTCS] &= ~(data & ABSTRACTCS_CMDERR_MASK)
+
+    elif address == DMI_SBCS:
+        sberror = dmi_mem[DMI_SBCS] & SBCS_SBERROR_MASK & ~data  # sberror is W1C
+        dmi_mem[DMI_SBCS] = (data & SBCS_CONFIG_MASK) | sberror
+
+    elif address == DMI_SBADDRESS0:
+        dmi_mem[DMI_SBADDRESS0] = data
+        if dmi_mem[DMI_SBCS] & SBCS_SBREADONADDR:
+            system_bus_access(session, write=False)
+
+    elif address == DMI_SBDATA0:
+        dmi_mem[DMI_SBDATA0] = data
+        system_bus_access(session, write=True)
 
     else:
         # ipdb.set_trace()
         dmi_mem[address] = data  # Now data is the original value 
         
-def execute_abstract_command(command):
+def execute_abstract_command(session, command):
     """Executes abstract commands (simplified for this example)."""
-    global dcsr, dpc
+    dmi_mem = session.dmi_mem
+    gprs = session.gprs
     command_type = (command >> 24) & 0xFF
     print(f"Executing abstract command: 0x{command_type:02X}")
   
@@ -349,14 +985,14 @@ def execute_abstract_command(command):
                     gprs[reg_num - 0x1000] = dmi_mem[DMI_DATA0]
                     print(f"  Writing 0x{dmi_mem[DMI_DATA0]:08X} to GPR {reg_num - 0x1000}")
                 elif reg_num == 0x4:
-                    dpc = dmi_mem[DMI_DATA0]
+                    session.dpc = dmi_mem[DMI_DATA0]
                     print(f"  Writing 0x{dmi_mem[DMI_DATA0]:08X} to DPC")
                 elif reg_num == 0x7b0:
-                    dcsr = dmi_mem[DMI_DATA0] & 0xFFFFFFFF
-                    print(f"  Writing 0x{dcsr:08X} to DCSR")
+                    session.dcsr = dmi_mem[DMI_DATA0] & 0xFFFFFFFF
+                    print(f"  Writing 0x{session.dcsr:08X} to DCSR")
                 elif reg_num == 0x301:
-                    dcsr = dmi_mem[DMI_DATA0] & 0xFFFFFFFF
-                    print(f"  Writing 0x{dcsr:08X} to DCSR")
+                    session.dcsr = dmi_mem[DMI_DATA0] & 0xFFFFFFFF
+                    print(f"  Writing 0x{session.dcsr:08X} to DCSR")
                 else:
                     print(f"  Write to register {reg_num} not implemented")
             else:
@@ -367,10 +1003,10 @@ def execute_abstract_command(command):
                     dmi_mem[DMI_DATA0] = data
                 elif reg_num == 0x4:
                     print(f"  Reading DPC, returning 0x00000000")
-                    dmi_mem[DMI_DATA0] = dpc 
+                    dmi_mem[DMI_DATA0] = session.dpc 
                 elif reg_num == 0x7b0:
-                    print(f"  Reading DCSR, returning 0x{dcsr:08X}")
-                    dmi_mem[DMI_DATA0] = dcsr
+                    print(f"  Reading DCSR, returning 0x{session.dcsr:08X}")
+                    dmi_mem[DMI_DATA0] = session.dcsr
                 elif reg_num == 0x300:
                     print(f"  Reading MSTATUS, returning 0xA00000200")
                     dmi_mem[DMI_DATA0] = 0xA00000200 
@@ -380,83 +1016,207 @@ def execute_abstract_command(command):
                 else:
                     print(f"  Read from register {reg_num} not implemented")
         return 0  # No error
+    elif command_type == 2:
+        # Access Memory command, arg0 (data0) holds the value and arg1 (data1) the address
+        aamsize = (command >> 20) & 0x7
+        aampostincrement = (command >> 19) & 0x1
+        write = (command >> 16) & 0x1
+        if aamsize > 2:
+            print(f"  Memory access size {8 << aamsize} bits not supported")
+            return 2  # Not supported
+        size = 1 << aamsize
+        address = dmi_mem[DMI_DATA1]
+        print(f"  Memory: 0x{address:08X}, size: {size}, write: {write}, postincrement: {aampostincrement}")
+        if write:
+            bus_write(session, address, size, dmi_mem[DMI_DATA0])
+        else:
+            dmi_mem[DMI_DATA0] = bus_read(session, address, size)
+        if aampostincrement:
+            dmi_mem[DMI_DATA1] = (address + size) & 0xFFFFFFFF
+        return 0  # No error
     else:
         print(f"  Command type {command_type} not implemented")
         return 7  # Command not implemented
 
-def main():
-    # threading.Thread(target=start_gdb_server, daemon=True).start()
+class DmiFrameParser:
+    """Splits the byte stream sent by riscv_socket_dmi.c into DMI requests.
+
+    Bytes are appended with feed() and complete requests are taken out with
+    frames(), which keeps a partial frame buffered until the rest arrives.
+    A header that cannot start a valid frame (unknown command, wrong data
+    length, non-zero reserved bytes) is treated as corruption: the parser
+    drops one byte and looks for the next plausible header, so it falls back
+    into step in place instead of needing a reconnect."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.resync_bytes = 0
+        self.resyncs = 0
+
+    def feed(self, data):
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        self.buffer += data
+
+    def _frame_length(self, pos):
+        """Return the length of a valid frame starting at `pos`, 0 if the
+        bytes there cannot start a frame, or None if more bytes are needed."""
+        buf = self.buffer
+        command = buf[pos]
+        if command == READ_COMMAND:
+            length = READ_FRAME_LENGTH
+        elif command == WRITE_COMMAND:
+            length = WRITE_FRAME_LENGTH
+        else:
+            return 0
+        available = len(buf) - pos
+        if available > 5 and buf[pos + 5] != DATA_LENGTH:
+            return 0
+        if command == READ_COMMAND and any(buf[pos + FRAME_HEADER_LENGTH:pos + min(available, length)]):
+            return 0
+        return length if available >= length else None
+
+    def frames(self):
+        """Yield (command, address, data, sequence) for every complete frame
+        buffered. data is None for reads."""
+        buf = self.buffer
+        while self.pos < len(buf):
+            length = self._frame_length(self.pos)
+            if length is None:
+                break
+            if length == 0:
+                if not self.resync_bytes:
+                    self.resyncs += 1
+                    print(f"Framing error at byte 0x{buf[self.pos]:02X}, resynchronising")
+                self.resync_bytes += 1
+                self.pos += 1
+                continue
+            command, address, _, sequence = struct.unpack_from(">BIBB", buf, self.pos)
+            data = None
+            if command == WRITE_COMMAND:
+                data = struct.unpack_from(">I", buf, self.pos + FRAME_HEADER_LENGTH)[0]
+            self.pos += length
+            if self.resync_bytes:
+                print(f"Resynchronised after skipping {self.resync_bytes} bytes")
+                self.resync_bytes = 0
+            yield command, address, data, sequence
+
+
+def handle_dmi_connection(conn, addr, session):
+    with conn:
+        print(f"Connected by {addr}")
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        parser = DmiFrameParser()
+        while True:
+            try:
+                # ipdb.set_trace()
+                data = conn.recv(4096)
+                if not data:
+                    break
+                print(f"Received raw data: {data.hex()}")
+                parser.feed(data)
+                for command, address, data, sequence in parser.frames():
+                    if session.last_reply and session.last_reply[0] == sequence:
+                        # Sent again after its reply was late, don't run it twice
+                        print(f"Request {sequence} sent again, repeating its reply")
+                        conn.sendall(session.last_reply[1])
+                        continue
+                    # Decided before the request runs, a dropped request has no effect
+                    delay = session.faults.reply_delay(address)
+                    if delay is None:
+                        print(f"Fault injection: dropping request {sequence} for Addr=0x{address:02X}")
+                        continue
+                    if dmi_stats:
+                        dmi_stats.record(command)
+                    if command == READ_COMMAND:
+                        data = handle_dmi_read(session, address)
+                        print(f"Unpacked READ data is {data}")
+                    else:
+                        print(f"Unpacked WRITE data is {data}")
+                        handle_dmi_write(session, address, data)
+                        data = 0
+                    send_reply(session, conn, sequence, data, delay)
+            except ConnectionResetError:
+                print("Client disconnected")
+                break
+        if parser.resyncs:
+            print(f"Connection needed {parser.resyncs} resynchronisations")
+        if session.faults.rules:
+            print(session.faults.summary())
+        print(f"Session {addr} closed, {len(session.memory.pages)} pages copied")
+
+def serve(host, port, new_session):
     # --- Main Server Loop ---
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
         s.listen()
-        print(f"Server listening on {HOST}:{PORT}")
+        print(f"Server listening on {host}:{port}")
         while True:
             conn, addr = s.accept()
-            with conn:
-                print(f"Connected by {addr}")
-                buffer = b''
-                while True:
-                    try:
-                        # ipdb.set_trace()
-                        data = conn.recv(1024)
-                        if not data:
-                            break
-                        print(f"Received raw data: {data.hex()}")
-                        buffer += data
-
-                        while len(buffer) >= 6:
-                            command, address, data_length = struct.unpack(">BIB", buffer[:6])
-                            print(f"Unpacked received command: 0x{command:01X}")
-                            print(f"Unpacked received address: 0x{address:04X}")
-                            print(f"Unpacked received data_length: 0x{data_length:01X}")
-                            if command == READ_COMMAND:
-                                # ipdb.set_trace()
-                                data = handle_dmi_read(address, conn)
-                                print(f"Unpacked READ data is {data}")
-                                print(f"READ COMMAND received, the whole buffer is: {buffer}")
-                                buffer = buffer[6:]
-                                print(f"READ COMMAND received, stripped buffer is: {buffer}")
-
-                            elif command == WRITE_COMMAND:
-                                if len(buffer) >= 10:
-                                    # ipdb.set_trace()
-                                    data = struct.unpack(">I", buffer[6:10])[0]
-                                    print(f"Unpacked WRITE data is {data}")
-                                    handle_dmi_write(address, data)
-                                    conn.sendall(struct.pack(">BI", RESPONSE_OK, 0))
-                                    print(f"WRITE COMMAND received, the whole buffer is: {buffer}")
-                                    buffer = buffer[10:]
-                                    print(f"WRITE COMMAND received, stripped buffer is: {buffer}")
-                                else:
-                                    break
-
-                            else:
-                                print (f"Received buffer with unknown command, the whole buffer is: {buffer}")
-                                print(f"Invalid command: {command}")
-                                conn.sendall(struct.pack(">BI", RESPONSE_ERROR, 0))
-                                buffer = buffer[6:]
-                        if not buffer:
-                            # If buffer is empty, receive at least 6 bytes
-                            received_data = conn.recv(6)
-                        else:
-                            # If buffer has some data, check for and remove stray '@'
-                            if buffer == b'@':
-                                print("Removing stray '@' from buffer")
-                                buffer = b''  # Clear the buffer
-                            # Receive at least 1 byte to make progress
-                            received_data = conn.recv(1)
-
-                        if not received_data:
-                            break  # Connection closed
-
-                        # buffer = b''
-                        # buffer += received_data
-                        buffer = received_data
-
-                    except ConnectionResetError:
-                        print("Client disconnected")
-                        break
-                buffer = b''
-
-main()
\ No newline at end of file
+            threading.Thread(target=handle_dmi_connection, args=(conn, addr, new_session()),
+                    daemon=True).start()
+
+def parse_base_image(text):
+    """Parse FILE[@ADDRESS] and map the file."""
+    path, _, address = text.partition("@")
+    return BaseImage(path, int(address, 0) if address else 0)
+
+def main(args):
+    global coverage, dmi_stats
+    parser = argparse.ArgumentParser(
+            description='Simulate a RISC-V debug module behind the OpenOCD '
+            'socket DMI transport.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default=HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--fault', action='append', default=[], type=parse_fault_rule,
+            metavar='KIND=RATE[:ARG][@ADDR]',
+            help='inject a fault with the given probability per matching DMI '
+            'access; KIND is one of busy, cmderr (ARG: cmderr code), '
+            'sbbusyerror, drop or delay (ARG: seconds). A dropped request costs '
+            'OpenOCD its reply timeout (reply_timeout MS, default 1000), so '
+            'keep delays below that. May be repeated.')
+    parser.add_argument('--fault-seed', type=int, default=0,
+            help='seed for the fault injection random generator')
+    parser.add_argument('--gdb-port', type=int, default=0,
+            help='also serve GDB directly on this port, 0 disables it')
+    parser.add_argument('--gdb-target-xml',
+            help='target description to give GDB instead of the built-in RV32 one')
+    parser.add_argument('--coverage', action='store_true',
+            help='count memory accesses per page and print a summary on shutdown')
+    parser.add_argument('--base-image', type=parse_base_image, metavar='FILE[@ADDR]',
+            help='read-only memory image shared by all sessions, mapped at '
+            'ADDR (default 0); each session gets copy-on-write pages on top')
+    parser.add_argument('--stats-port', type=int, default=0,
+            help='serve DMI request counts as JSON on this port, 0 disables it')
+    args = parser.parse_args(args)
+
+    # Every connection, DMI or GDB, gets a session of its own
+    new_session = functools.partial(Session, args.base_image, args.fault, args.fault_seed)
+    if args.coverage:
+        coverage = AccessCoverage()
+    if args.gdb_port:
+        if args.gdb_target_xml:
+            with open(args.gdb_target_xml, "rb") as f:
+                target_xml = TargetXml(f.read())
+        else:
+            target_xml = TargetXml(build_target_xml())
+        threading.Thread(target=start_gdb_server,
+                args=(args.host, args.gdb_port, target_xml, new_session), daemon=True).start()
+    if args.stats_port:
+        dmi_stats = DmiStats()
+        threading.Thread(target=start_stats_server, args=(args.host, args.stats_port),
+                daemon=True).start()
+    try:
+        serve(args.host, args.port, new_session)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if coverage:
+            print(coverage.summary())
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,6 +3,8 @@
 #include <string.h>
 #include <stdio.h>
 #include <unistd.h>
+#include <sys/socket.h>
+#include <sys/time.h>
 #include <arpa/inet.h>
 #include <netinet/tcp.h>
 #include "transport/transport.h"
@@ -10,14 +12,14 @@
 #include "target/riscv/riscv.h"
 #include "helper/log.h"
 
-#include <fcntl.h>
-#include <sys/select.h>
 #include <errno.h>
 
 typedef struct {
     int sockfd;
     char host[256];
     int port;
+    int timeout_ms;
+    uint8_t sequence;
 } socket_priv_t;
 
 // Commands for serialized socket message
@@ -28,64 +30,24 @@ typedef struct {
 #define RESPONSE_OK 0x00
 #define RESPONSE_ERROR 0x01
 
+// Frame sizes, must match script_server_simulator/dmi_socket_responder.py
+// Every request carries a sequence number, which its reply
+// [sequence][response code][data (4 bytes, 0 for a write)] starts with
+#define FRAME_SEQUENCE_OFFSET 6
+#define READ_FRAME_LENGTH 10
+#define WRITE_FRAME_LENGTH 11
+#define RESPONSE_LENGTH 6
+
 #define DEFAULT_SOCKET_HOST "127.0.0.1"
 #define DEFAULT_SOCKET_PORT 5555
 
-static int transportIsRegistered = -1;
-
-int clear_socket_buffer(int sockfd) {
-    int flags = fcntl(sockfd, F_GETFL, 0);
-    if (flags == -1) {
-        perror("fcntl(F_GETFL)");
-        return -1;
-    }
-
-    // Make socket non-blocking
-    if (fcntl(sockfd, F_SETFL, flags | O_NONBLOCK) == -1) {
-        perror("fcntl(F_SETFL, O_NONBLOCK)");
-        return -1;
-    }
-
-    fd_set readfds;
-    struct timeval timeout;
-    int ret;
-    char buf[1024]; // Buffer to discard data
-
-    do {
-        FD_ZERO(&readfds);
-        FD_SET(sockfd, &readfds);
-
-        // Set a short timeout (e.g., 100 milliseconds)
-        timeout.tv_sec = 0;
-        timeout.tv_usec = 100000;
-
-        ret = select(sockfd + 1, &readfds, NULL, NULL, &timeout);
-        if (ret == -1) {
-            perror("select");
-            return -1;
-        } else if (ret > 0) {
-            // Data is available to read
-            ssize_t bytes_read = recv(sockfd, buf, sizeof(buf), 0);
-            if (bytes_read == -1) {
-                if (errno == EAGAIN || errno == EWOULDBLOCK) {
-                    // No more data (expected in non-blocking mode)
-                    break;
-                } else {
-                    perror("recv");
-                    return -1;
-                }
-            }
-        }
-    } while (ret > 0);
-
-    // Restore original socket flags (if needed)
-    if (fcntl(sockfd, F_SETFL, flags) == -1) {
-        perror("fcntl(F_SETFL, flags)");
-        return -1;
-    }
+// How long to wait for a reply before giving up on it. A request that got no reply
+// is sent again up to SOCKET_RETRIES times, waiting twice as long each time. The
+// server runs a request it has already run only once, and answers it again.
+#define DEFAULT_SOCKET_TIMEOUT_MS 1000
+#define SOCKET_RETRIES 3
 
-    return 0;
-}
+static int transportIsRegistered = -1;
 
 static int recv_all(int sockfd, void *buf, size_t len) {
     size_t to_read = len;
@@ -96,6 +58,12 @@ static int recv_all(int sockfd, void *buf, size_t len) {
         ssize_t bytes_read = recv(sockfd, temp_buf + total_bytes_read, to_read, 0);
 
         if (bytes_read < 0) {
+            if (errno == EINTR)
+                continue;
+            if (errno == EAGAIN || errno == EWOULDBLOCK) {
+                LOG_WARNING("No reply from the DMI server in time");
+                return ERROR_TIMEOUT_REACHED;
+            }
             LOG_ERROR("recv error: %s", strerror(errno));
             return ERROR_FAIL; 
         } else if (bytes_read == 0) {
@@ -110,6 +78,66 @@ static int recv_all(int sockfd, void *buf, size_t len) {
     return total_bytes_read;
 }
 
+static int set_recv_timeout(int sockfd, int timeout_ms) {
+    struct timeval tv = {
+        .tv_sec = timeout_ms / 1000,
+        .tv_usec = (timeout_ms % 1000) * 1000,
+    };
+    return setsockopt(sockfd, SOL_SOCKET, SO_RCVTIMEO, &tv, sizeof(tv));
+}
+
+// Wait for the reply to the request with the given sequence number. Replies to
+// earlier requests, which came too late or were answered twice, are skipped.
+static int recv_reply(int sockfd, uint8_t sequence, uint8_t *reply) {
+    for (;;) {
+        int received_bytes = recv_all(sockfd, reply, RESPONSE_LENGTH);
+        if (received_bytes == ERROR_TIMEOUT_REACHED)
+            return ERROR_TIMEOUT_REACHED;
+        if (received_bytes != RESPONSE_LENGTH) {
+            LOG_ERROR("Failed to receive DMI reply: received %d bytes, expected %d",
+                    received_bytes, RESPONSE_LENGTH);
+            return ERROR_FAIL;
+        }
+        if (reply[0] == sequence)
+            return ERROR_OK;
+        LOG_DEBUG("Skipping the stale reply to DMI request %d", reply[0]);
+    }
+}
+
+// Send a request and read its reply. If no reply comes in time, e.g. because the
+// request was lost, the request is sent again with a longer timeout.
+static int socket_dmi_transfer(socket_priv_t *priv, uint8_t *request, size_t request_length,
+        uint8_t *reply) {
+    uint8_t sequence = ++priv->sequence;
+    request[FRAME_SEQUENCE_OFFSET] = sequence;
+    int timeout_ms = priv->timeout_ms;
+    int result;
+    for (int attempt = 0; ; attempt++) {
+        ssize_t sent = send(priv->sockfd, request, request_length, 0);
+        if (sent != (ssize_t)request_length) {
+            LOG_ERROR("Failed to send DMI request: %s", strerror(errno));
+            result = ERROR_FAIL;
+            break;
+        }
+
+        result = recv_reply(priv->sockfd, sequence, reply);
+        if (result != ERROR_TIMEOUT_REACHED)
+            break;
+        if (attempt == SOCKET_RETRIES) {
+            LOG_ERROR("No reply from the DMI server after %d attempts", attempt + 1);
+            break;
+        }
+        timeout_ms *= 2;
+        LOG_DEBUG("Sending DMI request again, waiting up to %d ms for the reply", timeout_ms);
+        if (set_recv_timeout(priv->sockfd, timeout_ms) < 0)
+            LOG_WARNING("Failed to set the socket receive timeout: %s", strerror(errno));
+    }
+    // Only retries wait longer
+    if (timeout_ms != priv->timeout_ms && set_recv_timeout(priv->sockfd, priv->timeout_ms) < 0)
+        LOG_WARNING("Failed to set the socket receive timeout: %s", strerror(errno));
+    return result;
+}
+
 static int socket_dmi_connect(dtm_driver_t* driver){
     if (!driver->priv) {
         return ERROR_FAIL;
@@ -147,6 +175,13 @@ static int socket_dmi_connect(dtm_driver_t* driver){
         return ERROR_FAIL;
     }
 
+    // Every DMI access is a small request waiting for a small reply, don't let Nagle hold them back
+    int nodelay = 1;
+    if (setsockopt(priv->sockfd, IPPROTO_TCP, TCP_NODELAY, &nodelay, sizeof(nodelay)) < 0)
+        LOG_WARNING("Failed to set TCP_NODELAY on the socket: %s", strerror(errno));
+    if (set_recv_timeout(priv->sockfd, priv->timeout_ms) < 0)
+        LOG_WARNING("Failed to set the socket receive timeout: %s", strerror(errno));
+
     return ERROR_OK;
 }
 
@@ -162,6 +197,8 @@ int socket_dmi_init(dtm_driver_t *driver) {
     strncpy(priv->host, DEFAULT_SOCKET_HOST, sizeof(priv->host) - 1);
     priv->host[sizeof(priv->host) - 1] = '\0';
     priv->port = DEFAULT_SOCKET_PORT;
+    priv->timeout_ms = DEFAULT_SOCKET_TIMEOUT_MS;
+    priv->sequence = 0;
 
     priv->sockfd = -1; // Initialize to -1 to indicate not connected yet
     driver->priv = priv;
@@ -209,51 +246,33 @@ int socket_dmi_read_dmi(dtm_driver_t *driver, uint32_t *data, uint32_t address)
         }
     }
     const size_t data_length = 4;
-    uint8_t buffer[9];
-    // Protocol: [READ_COMMAND][address (4 bytes)][data_length (1 byte, fixed as 4 for now)][Reserved (3 bytes)]
+    uint8_t buffer[READ_FRAME_LENGTH];
+    // Protocol: [READ_COMMAND][address (4 bytes)][data_length (1 byte, fixed as 4 for now)][sequence (1 byte)][Reserved (3 bytes)]
     buffer[0] = READ_COMMAND; 
     buffer[1] = (address >> 24) & 0xFF;
     buffer[2] = (address >> 16) & 0xFF;
     buffer[3] = (address >> 8) & 0xFF;
     buffer[4] = address & 0xFF;
     buffer[5] = data_length; // data length in bytes (fixed at 4)
+    // buffer[6], the sequence number, is set by socket_dmi_transfer()
     // Reserved bytes
-    buffer[6] = 0x00;
     buffer[7] = 0x00;
     buffer[8] = 0x00;
+    buffer[9] = 0x00;
 
-    if (clear_socket_buffer(priv->sockfd) != 0) {
-        LOG_ERROR("Failed to clear socket buffer in socket_dmi_read_dmi");
-        return ERROR_FAIL;
+    uint8_t response_buffer[RESPONSE_LENGTH];
+    int result = socket_dmi_transfer(priv, buffer, sizeof(buffer), response_buffer);
+    if (result != ERROR_OK) {
+        LOG_ERROR("Failed to read DMI address 0x%x", address);
+        return result;
     }
 
-    ssize_t sent = send(priv->sockfd, buffer, sizeof(buffer), 0);
-    if (sent != sizeof(buffer)) {
-        perror("Failed to send read DMI command");
-        return ERROR_FAIL;
-    }
-
-    const size_t response_length = 1;
-    uint8_t response_buffer[response_length];
-    size_t received_bytes = recv_all(priv->sockfd, response_buffer, response_length);
-    if (received_bytes != response_length) {
-        LOG_ERROR("Failed to receive response byte: received %zd bytes, expected 1", received_bytes);
-        return ERROR_FAIL;
-    }
-
-    if (response_buffer[0] != RESPONSE_OK) {
-        LOG_ERROR("DMI read failed (error code: 0x%X)", response_buffer[0]);
+    if (response_buffer[1] != RESPONSE_OK) {
+        LOG_ERROR("DMI read failed (error code: 0x%X)", response_buffer[1]);
         return -1;
     }
 
-    uint8_t data_buffer[data_length];
-    received_bytes = recv_all(priv->sockfd, data_buffer, data_length);
-
-    if (received_bytes != data_length) {
-        LOG_ERROR("Failed to receive data: received %zd bytes, expected %zd", received_bytes, data_length);
-        return ERROR_FAIL;
-    }
-
+    const uint8_t *data_buffer = response_buffer + 2;
     *data = (data_buffer[0] << 24) |
             (data_buffer[1] << 16) |
             (data_buffer[2] << 8) |
@@ -277,38 +296,29 @@ int socket_dmi_write_dmi(dtm_driver_t *driver, uint32_t address, uint32_t data)
             return -1;
         }
     }
-    uint8_t buffer[10];
-    // Protocol: [WRITE_COMMAND][address (4 bytes)][data_length (1 byte, fixed as 4 for now)][data (4 bytes)]
+    uint8_t buffer[WRITE_FRAME_LENGTH];
+    // Protocol: [WRITE_COMMAND][address (4 bytes)][data_length (1 byte, fixed as 4 for now)][sequence (1 byte)][data (4 bytes)]
     buffer[0] = WRITE_COMMAND;
     buffer[1] = (address >> 24) & 0xFF;
     buffer[2] = (address >> 16) & 0xFF;
     buffer[3] = (address >> 8) & 0xFF;
     buffer[4] = address & 0xFF;
     buffer[5] = 4; // data length in bytes (fixed at 4)
-    buffer[6] = (data >> 24) & 0xFF;
-    buffer[7] = (data >> 16) & 0xFF;
-    buffer[8] = (data >> 8) & 0xFF;
-    buffer[9] = data & 0xFF;
-
-    if (clear_socket_buffer(priv->sockfd) != 0) {
-        LOG_ERROR("Failed to clear socket buffer in socket_dmi_write_dmi");
-        return ERROR_FAIL;
-    }
+    // buffer[6], the sequence number, is set by socket_dmi_transfer()
+    buffer[7] = (data >> 24) & 0xFF;
+    buffer[8] = (data >> 16) & 0xFF;
+    buffer[9] = (data >> 8) & 0xFF;
+    buffer[10] = data & 0xFF;
 
-    ssize_t sent = send(priv->sockfd, buffer, sizeof(buffer), 0);
-    if (sent != sizeof(buffer)) {
-        perror("Failed to send write DMI command");
-        return ERROR_FAIL;
+    uint8_t recv_buffer[RESPONSE_LENGTH];
+    int result = socket_dmi_transfer(priv, buffer, sizeof(buffer), recv_buffer);
+    if (result != ERROR_OK) {
+        LOG_ERROR("Failed to write DMI address 0x%x", address);
+        return result;
     }
 
-    uint8_t recv_buffer[1];
-    ssize_t received_bytes = recv_all(priv->sockfd, recv_buffer, 1);
-    if (received_bytes != 1) {
-        return ERROR_FAIL;
-    }
-
-    if (recv_buffer[0] != RESPONSE_OK) {
-        LOG_ERROR("DMI write failed (error code: 0x%X)", buffer[0]);
+    if (recv_buffer[1] != RESPONSE_OK) {
+        LOG_ERROR("DMI write failed (error code: 0x%X)", recv_buffer[1]);
         return -1;
     }
 
@@ -343,6 +353,26 @@ COMMAND_HANDLER(command_socket_port){
     return ERROR_OK;
 }
 
+COMMAND_HANDLER(command_socket_reply_timeout){
+	if (CMD_ARGC != 1)
+		return ERROR_COMMAND_SYNTAX_ERROR;
+    dtm_driver_t *active_driver = get_active_dtm_driver();
+    if (!active_driver || strcmp(active_driver->name, "socket") != 0) {
+        LOG_ERROR("Active DTM driver is not socket");
+        return ERROR_FAIL;
+    }
+
+    socket_priv_t *priv = (socket_priv_t*)active_driver->priv;
+    int timeout_ms;
+    COMMAND_PARSE_NUMBER(int, CMD_ARGV[0], timeout_ms);
+    if (timeout_ms <= 0)
+        return ERROR_COMMAND_ARGUMENT_INVALID;
+    priv->timeout_ms = timeout_ms;
+    if (priv->sockfd != -1 && set_recv_timeout(priv->sockfd, timeout_ms) < 0)
+        LOG_WARNING("Failed to set the socket receive timeout: %s", strerror(errno));
+    return ERROR_OK;
+}
+
 COMMAND_HANDLER(command_socket_connect){
     dtm_driver_t *active_driver = get_active_dtm_driver();
     if (!active_driver || strcmp(active_driver->name, "socket") != 0) {
@@ -404,6 +434,13 @@ static const struct command_registration socket_transport_command_handlers[] = {
         .usage = "<port>",
         .handler = command_socket_port,
     },
+    {
+        .name = "reply_timeout",
+        .mode = COMMAND_ANY,
+        .help = "Set how many milliseconds to wait for a DMI reply before sending the request again",
+        .usage = "<milliseconds>",
+        .handler = command_socket_reply_timeout,
+    },
     {
         .name = "connect",
         .mode = COMMAND_ANY,
@@ -1,7 +1,26 @@
 #!/usr/bin/env python3
 
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import io
+import itertools
+import locale
+import lzma
+import mmap
+import operator
+import os
+import pickle
+import select
+import shutil
+import stat
 import sys
 import re
+import tempfile
+import time
 
 # This function is the only OpenOCD-specific part of this script.
 def make_canonical(line):
@@ -12,89 +31,699 @@ def make_canonical(line):
     else:
         return line
 
-def buf_startswith(buf, sequence):
-    if len(buf) < len(sequence):
-        return False
-    for i, entry in enumerate(sequence):
-        if entry[1] != buf[i][1]:
-            return False
-    return True
+# Polynomial rolling hash over line IDs, see LineWindow
+HASH_MODULUS = (1 << 61) - 1
+HASH_BASE = 1000003
 
-def shorten_buffer(outfd, buf, current_repetition):
-    """Do something to the buffer to make it shorter. If we can't compress
-    anything, then print out the first line and remove it."""
-    length_before = len(buf)
+class LineWindow:
+    """The lines compress_log() looks for repetitions in, oldest first.
+
+    Every line is kept with an interned ID of its canonical form, so lines
+    compare as ints, and with a rolling hash of all IDs up to it, so two runs
+    of lines compare by hash in O(1). Runs whose hashes match are verified
+    ID by ID before they are treated as equal.
+
+    Lines are held in deques, so discarding from the front is O(1) per line,
+    and interned IDs are reference counted, so only the canonical lines in
+    the window (or held, see hold()) are kept, however long the log is.
+    The positions of every ID in the window are kept as well, so the
+    recurrences of a line are found without scanning the window."""
+
+    def __init__(self):
+        self.lines = collections.deque()
+        self.ids = collections.deque()
+        # prefix[i] is the hash of all IDs before ids[i], including those
+        # already discarded, which cancel out when comparing runs
+        self.prefix = collections.deque([0])
+        self.powers = [1]
+        # canonical line -> ID, and ID -> canonical line, references
+        self.intern = {}
+        self.canonical = {}
+        self.refs = {}
+        self.next_id = 0
+        # ID -> line numbers it is at in the window, counting from the start
+        # of the log; start is the line number of the first line
+        self.positions = {}
+        self.start = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, line):
+        canonical = make_canonical(line)
+        line_id = self.intern.get(canonical)
+        if line_id is None:
+            line_id = self.intern[canonical] = self.next_id
+            self.next_id += 1
+            self.canonical[line_id] = canonical
+            self.refs[line_id] = 1
+            self.positions[line_id] = collections.deque()
+        else:
+            self.refs[line_id] += 1
+        self.positions[line_id].append(self.start + len(self.ids))
+        self.lines.append(line)
+        self.ids.append(line_id)
+        self.prefix.append((self.prefix[-1] * HASH_BASE + line_id + 1) % HASH_MODULUS)
+
+    def discard(self, n):
+        """Remove the first n lines."""
+        refs = self.refs
+        positions = self.positions
+        for _ in range(n):
+            self.lines.popleft()
+            self.prefix.popleft()
+            line_id = self.ids.popleft()
+            positions[line_id].popleft()
+            if refs[line_id] == 1:
+                del refs[line_id]
+                del positions[line_id]
+                del self.intern[self.canonical.pop(line_id)]
+            else:
+                refs[line_id] -= 1
+        self.start += n
+
+    def hold(self, ids):
+        """Keep the IDs valid after their lines are discarded, until
+        release()d, so lines appended later still get the same IDs."""
+        for line_id in ids:
+            self.refs[line_id] += 1
+
+    def release(self, ids):
+        refs = self.refs
+        for line_id in ids:
+            refs[line_id] -= 1
+            if not refs[line_id]:
+                del refs[line_id]
+                del self.positions[line_id]
+                del self.intern[self.canonical.pop(line_id)]
+
+    def startswith(self, ids):
+        return len(self.ids) >= len(ids) and all(map(operator.eq, ids, self.ids))
+
+    def is_prefix_of(self, ids):
+        return len(self.ids) < len(ids) and all(map(operator.eq, self.ids, ids))
+
+    def period_match(self, length):
+        """Return how many lines, from line `length` on, equal the line
+        `length` lines before them."""
+        ids = self.ids
+        return next(itertools.compress(itertools.count(),
+                map(operator.ne, itertools.islice(ids, length, None), ids)),
+                len(ids) - length)
+
+    def smallest_square(self, limit):
+        """Return (length, period_match(length)) for the smallest length below
+        limit whose first `length` lines are repeated right after them, or
+        None. Only lengths at which the first line recurs, and after it the
+        second and last, are hashed."""
+        ids = self.ids
+        prefix = self.prefix
+        powers = self.powers
+        while len(powers) < limit:
+            powers.append(powers[-1] * HASH_BASE % HASH_MODULUS)
+        second = ids[1] if len(ids) > 1 else None
+        start = prefix[0]
+        for position in itertools.islice(self.positions[ids[0]], 1, None):
+            length = position - self.start
+            if length >= limit:
+                return None
+            if ids[2 * length - 1] != ids[length - 1] or (length > 1 and ids[length + 1] != second):
+                continue
+            power = powers[length]
+            middle = prefix[length]
+            if (middle - start * power - prefix[2 * length] + middle * power) % HASH_MODULUS == 0:
+                matched = self.period_match(length)
+                if matched >= length:
+                    return length, matched
+        return None
+
+def write_repetition(outfd, window, sequence, repeated):
+    outfd.write("## The following %d lines repeat %d times:\n" % (len(sequence), repeated))
+    for line_id in sequence:
+        outfd.write("# %s" % window.canonical[line_id])
+
+def shorten_buffer(outfd, window, current_repetition):
+    """Do something to the window to make it shorter. If we can't compress
+    anything, then print out the first line and remove it.
+
+    current_repetition is [IDs of the repeated lines, repeat count] for a
+    repetition that ran up to the end of the window, so may be continued."""
+    length_before = len(window)
 
     if current_repetition:
-        while buf_startswith(buf, current_repetition[0]):
-            del buf[:len(current_repetition[0])]
+        sequence = current_repetition[0]
+        while window.startswith(sequence):
+            window.discard(len(sequence))
             current_repetition[1] += 1
-        if len(buf) < length_before:
+        if len(window) < length_before:
             return current_repetition
-        outfd.write("## The following %d lines repeat %d times:\n" % (
-                len(current_repetition[0]), current_repetition[1]))
-        for entry in current_repetition[0]:
-            outfd.write("# %s" % entry[1])
-
-    # Look for repeated sequences...
-    repetitions = []
-    for length in range(1, int(len(buf)/2)):
-        # Is there a repeating sequence of `length` lines?
-        matched_lines = 0
-        for i, entry in enumerate(buf[length:]):
-            if entry[1] == buf[i % length][1]:
-                matched_lines += 1
-            else:
-                break
-        if matched_lines >= length:
-            repetitions.append((matched_lines + length, length))
+        write_repetition(outfd, window, *current_repetition)
+        window.release(sequence)
 
-    if repetitions:
-        repetitions.sort(key=lambda entry: -entry[1])
-        matched_lines, length = repetitions[-1]
-        repeated = int(matched_lines / length)
+    # Look for the shortest repeated sequence at the start of the window
+    square = window.smallest_square(length_before // 2)
+    if square:
+        length, matched_lines = square
+        matched_lines += length
+        repeated = matched_lines // length
         if repeated * length >= 3:
-            sequence = buf[:length]
-            del buf[:repeated * length]
+            sequence = list(itertools.islice(window.ids, length))
 
             if matched_lines == length_before:
                 # Could be continued...
+                window.hold(sequence)
+                window.discard(repeated * length)
                 return [sequence, repeated]
 
             else:
-                outfd.write("## The following %d lines repeat %d times:\n" %
-                        (length, repeated))
-                for entry in sequence:
-                    outfd.write("# %s" % entry[1])
+                write_repetition(outfd, window, sequence, repeated)
+                window.discard(repeated * length)
                 return None
 
-    if len(buf) >= length_before:
-        line, _ = buf[0]
-        outfd.write(line)
-        buf.pop(0)
-
-    if length_before <= len(buf):
-        print("Buffer:")
-        for entry in buf:
-            print("%r" % entry[0])
-        assert False
-
+    outfd.write(window.lines[0])
+    window.discard(1)
     return None
 
+def finish(outfd, window, current_repetition):
+    """Compress and write out whatever is left in the window at the end of
+    the log, including a repetition that ran up to the end."""
+    while len(window) > 0:
+        current_repetition = shorten_buffer(outfd, window, current_repetition)
+    if current_repetition:
+        write_repetition(outfd, window, *current_repetition)
+
 def compress_log(infd, outfd, window):
-    """Compress log by finding repeated runs of lines. Runs in O(lines *
-    window**2), which can probably be improved."""
-    # Contains line, canonical tuples
-    buf = []
+    """Compress log by finding repeated runs of lines. For every line, the
+    window is scanned once for recurrences of its first line, and only those
+    are compared, by rolling hash, so the cost is about O(lines * window)
+    int compares in C rather than O(lines * window**2) string compares."""
+    lines = LineWindow()
     current_repetition = None
 
     for line in infd:
-        buf.append((line, make_canonical(line)))
-        if len(buf) > window:
-            current_repetition = shorten_buffer(outfd, buf, current_repetition)
+        lines.append(line)
+        if len(lines) > window:
+            current_repetition = shorten_buffer(outfd, lines, current_repetition)
+
+    finish(outfd, lines, current_repetition)
+
+def read_lines(f, end=None):
+    """Yield the lines of binary file f from where it is up to byte offset
+    end, which must be at the start of a line, decoded and with newlines
+    translated as reading the file in text mode would. Unlike a text mode
+    file, f.tell() stays usable while reading."""
+    encoding = locale.getpreferredencoding(False)
+    readline = f.readline
+    # Pipes cannot tell(), but are never read up to an offset
+    pos = f.tell() if end is not None else 0
+    while end is None or pos < end:
+        line = readline()
+        if not line:
+            return
+        pos += len(line)
+        line = line.decode(encoding)
+        if "\r" in line:
+            yield from line.replace("\r\n", "\n").replace("\r", "\n").splitlines(True)
+        else:
+            yield line
+
+# --- Compressed and memory mapped files ---
+
+# Compression formats: the magic number input is recognised by, and the file
+# name extension output is recognised by
+COMPRESSION_FORMATS = {
+    "gzip": (b"\x1f\x8b", ".gz"),
+    "bzip2": (b"BZh", ".bz2"),
+    "xz": (b"\xfd7zXZ\x00", ".xz"),
+    "zstd": (b"\x28\xb5\x2f\xfd", ".zst"),
+}
+
+# gzip's default, faster than that of the gzip module
+GZIP_LEVEL = 6
+
+def open_zstd(f, mode):
+    """Open binary file object f for reading or writing zstd, with the
+    standard library module if there is one (Python 3.14), otherwise with the
+    zstandard package."""
+    try:
+        from compression import zstd
+        return zstd.ZstdFile(f, mode)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        sys.exit("zstd needs Python 3.14 or the zstandard package (pip install zstandard)")
+    if mode == "rb":
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f,
+                read_across_frames=True, closefd=False))
+    return zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+
+def open_compressed(f, format, mode):
+    """Open binary file object f for reading or writing in a compression
+    format. Closing the result does not close f."""
+    if format == "gzip":
+        return gzip.GzipFile(fileobj=f, mode=mode, compresslevel=GZIP_LEVEL)
+    if format == "bzip2":
+        return bz2.BZ2File(f, mode)
+    if format == "xz":
+        return lzma.LZMAFile(f, mode)
+    return open_zstd(f, mode)
+
+def compression_format(f):
+    """Return the compression format of buffered binary file f, by its first
+    bytes, without consuming them; None if it is not compressed."""
+    head = f.peek(6)
+    for format, (magic, _) in COMPRESSION_FORMATS.items():
+        if head.startswith(magic):
+            return format
+    return None
+
+@contextlib.contextmanager
+def open_log(f):
+    """Open a log for read_lines(), given its path or a buffered binary file
+    object such as sys.stdin.buffer: decompressed as it is read if it is
+    compressed, otherwise mapped into memory if it is a regular file, so
+    lines are read straight out of the page cache."""
+    with contextlib.ExitStack() as stack:
+        if isinstance(f, str):
+            f = stack.enter_context(open(f, "rb"))
+        format = compression_format(f)
+        if format:
+            yield stack.enter_context(open_compressed(f, format, "rb"))
+            return
+        try:
+            # Fails for empty files and pipes
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            yield f
+            return
+        with mapped:
+            mapped.seek(f.tell())
+            yield mapped
+
+@contextlib.contextmanager
+def open_output(path, format=None):
+    """Open the output for writing text: file `path`, or standard output if
+    it is None, compressed in `format` or, if that is None, in the format
+    the extension of path is that of, if any."""
+    if format is None and path:
+        format = next((format for format, (_, extension) in COMPRESSION_FORMATS.items()
+                if path.endswith(extension)), None)
+    with contextlib.ExitStack() as stack:
+        if not format:
+            yield stack.enter_context(open(path, "w")) if path else sys.stdout
+            return
+        f = stack.enter_context(open(path, "wb")) if path else sys.stdout.buffer
+        yield stack.enter_context(io.TextIOWrapper(open_compressed(f, format, "wb"),
+                encoding=locale.getpreferredencoding(False)))
+
+# How often a regular file is polled for more data in follow mode, in seconds
+FOLLOW_POLL_INTERVAL = 0.1
+
+class LiveOutput:
+    """Output of follow_log(). A repetition still going on is shown as a
+    running counter: on a terminal one status line rewritten in place,
+    otherwise a line each time the count has changed."""
+
+    def __init__(self, outfd):
+        self.outfd = outfd
+        self.tty = outfd.isatty()
+        self.status_shown = False
+        self.shown = (None, None)
+
+    def write(self, text):
+        if self.status_shown:
+            self.outfd.write("\r\033[K")
+            self.status_shown = False
+        self.outfd.write(text)
+
+    def flush(self):
+        self.outfd.flush()
+
+    def status(self, window, current_repetition):
+        if not current_repetition:
+            return
+        sequence, repeated = current_repetition
+        if self.shown == (id(current_repetition), repeated):
+            return
+        self.shown = (id(current_repetition), repeated)
+        text = "## %d lines repeating, %d times so far: %s" % (
+                len(sequence), repeated, window.canonical[sequence[0]].rstrip())
+        if self.tty:
+            self.write("\r" + text[:shutil.get_terminal_size().columns - 1])
+            self.status_shown = True
+        else:
+            self.write(text + "\n")
 
-    while len(buf) > 0:
-        current_repetition = shorten_buffer(outfd, buf, current_repetition)
+def drain(outfd, window, current_repetition):
+    """Write out as much of the window as possible, except lines that the
+    open repetition may continue with."""
+    while len(window) > 0:
+        if current_repetition and window.is_prefix_of(current_repetition[0]):
+            break
+        current_repetition = shorten_buffer(outfd, window, current_repetition)
+    return current_repetition
+
+def follow_log(infd, outfd, window, flush_lines, flush_interval):
+    """Like compress_log(), for a log that is still being written, e.g. by
+    a running OpenOCD. Input is processed as it arrives, and no line waits
+    more than flush_interval seconds, or flush_lines lines, to be written,
+    except lines that may continue a repetition, which is shown as a running
+    counter instead. A regular file is followed like tail -f does, until
+    interrupted."""
+    out = LiveOutput(outfd)
+    lines = LineWindow()
+    current_repetition = None
+
+    fd = infd.fileno()
+    regular = stat.S_ISREG(os.fstat(fd).st_mode)
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))("replace")
+    partial = ""
+    # Lines read since the window was last drained, and when the first of
+    # them has to be written by
+    pending = 0
+    deadline = None
+
+    try:
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            data = None
+            if select.select([fd], [], [], timeout)[0]:
+                data = os.read(fd, 65536)
+                if not data:
+                    if not regular:
+                        break
+                    time.sleep(FOLLOW_POLL_INTERVAL if timeout is None else
+                            min(timeout, FOLLOW_POLL_INTERVAL))
+            if data:
+                *complete, partial = (partial + decoder.decode(data)).split("\n")
+                for line in complete:
+                    lines.append(line + "\n")
+                    if len(lines) > window:
+                        current_repetition = shorten_buffer(out, lines, current_repetition)
+                if complete and deadline is None:
+                    deadline = time.monotonic() + flush_interval
+                pending += len(complete)
+            if deadline is not None and (pending >= flush_lines or time.monotonic() >= deadline):
+                current_repetition = drain(out, lines, current_repetition)
+                out.status(lines, current_repetition)
+                out.flush()
+                pending = 0
+                deadline = None
+    except KeyboardInterrupt:
+        pass
+
+    partial += decoder.decode(b"", final=True)
+    if partial:
+        lines.append(partial)
+    finish(out, lines, current_repetition)
+    out.flush()
+
+# --- Timing profile ---
+
+# Time stamp, in ms since OpenOCD started, and source location of a log line
+TIMING_PATTERN = re.compile(r"(?:Debug|Error|Info |User |Warn ): \d+ (\d+) (?:(\S+:\d+ \w+\(\)):)?")
+# Header write_repetition() writes
+REPETITION_PATTERN = re.compile(r"## The following (\d+) lines repeat (\d+) times:\n")
+
+UNKNOWN_LOCATION = "(no location)"
+
+def timed_lines(lines):
+    """Yield (line, location, ms) for every line. ms is the time from the
+    time stamp of the line to that of the next line that has one, i.e. the
+    time spent after the line was logged, up to the next message, which is
+    charged to the location that logged it. Lines without a time stamp have
+    no location and take no time."""
+    last = None
+    # Lines after the last time stamped one
+    held = []
+    for line in lines:
+        m = TIMING_PATTERN.match(line)
+        if not m:
+            if last:
+                held.append(line)
+            else:
+                yield line, None, 0
+            continue
+        stamp = int(m.group(1))
+        if last:
+            # A later log can restart the clock
+            yield last[0], last[1], max(0, stamp - last[2])
+            for held_line in held:
+                yield held_line, None, 0
+            held = []
+        last = (line, m.group(2) or UNKNOWN_LOCATION, stamp)
+    if last:
+        yield last[0], last[1], 0
+        for held_line in held:
+            yield held_line, None, 0
+
+def canonical_rotation(sequence):
+    """Return the rotation of sequence that sorts first, as a tuple, so a
+    loop is counted as one block whichever of its lines the repetitions of
+    it start at."""
+    return min(tuple(sequence[i:] + sequence[:i]) for i in range(len(sequence)))
+
+class TimingProfile:
+    """Output of compress_log() for --profile. Instead of writing the
+    compressed log, it charges the time of every line (see timed_lines()) to
+    its source location and, if the line was compressed into a repetition,
+    to that repeated block, and reports where the time went.
+
+    Lines are passed through read() on their way into compress_log(), which
+    records their time until they come out of the window again as a write()
+    of the line itself or of a repetition they are part of."""
+
+    def __init__(self):
+        # location -> [ms, lines]
+        self.locations = collections.defaultdict(lambda: [0, 0])
+        # canonical lines of a repeated block, see canonical_rotation(),
+        # -> [ms, repeats, runs]
+        self.blocks = collections.defaultdict(lambda: [0, 0, 0])
+        # (line, ms) of the lines read but not written yet
+        self.pending = collections.deque()
+        self.ms = 0
+        self.lines = 0
+        # (length, repeats, canonical lines so far) of the repetition
+        # being written
+        self.repetition = None
+
+    def read(self, lines):
+        for line, location, ms in timed_lines(lines):
+            if location:
+                counts = self.locations[location]
+                counts[0] += ms
+                counts[1] += 1
+            self.ms += ms
+            self.lines += 1
+            self.pending.append((line, ms))
+            yield line
+
+    def write(self, text):
+        if self.repetition:
+            length, repeated, sequence = self.repetition
+            sequence.append(text[2:])
+            if len(sequence) == length:
+                self.repetition = None
+                ms = sum(self.pending.popleft()[1] for _ in range(length * repeated))
+                counts = self.blocks[canonical_rotation(sequence)]
+                counts[0] += ms
+                counts[1] += repeated
+                counts[2] += 1
+            return
+        if self.pending and text == self.pending[0][0]:
+            self.pending.popleft()
+            return
+        # Anything else that is neither a line read nor a repetition has no
+        # time of its own
+        m = REPETITION_PATTERN.match(text)
+        if m:
+            self.repetition = (int(m.group(1)), int(m.group(2)), [])
+
+    def report(self, outfd, top):
+        total = self.ms or 1
+        outfd.write("%.3f s in %d lines\n\n" % (self.ms / 1000, self.lines))
+        outfd.write("%10s %6s %9s  %s\n" % ("seconds", "%", "lines", "location"))
+        locations = sorted(self.locations.items(), key=lambda item: item[1][0], reverse=True)
+        for location, (ms, lines) in locations[:top]:
+            outfd.write("%10.3f %6.1f %9d  %s\n" % (ms / 1000, 100 * ms / total, lines, location))
+
+        blocks = sorted(self.blocks.items(), key=lambda item: item[1][0], reverse=True)
+        for sequence, (ms, repeated, runs) in blocks[:top]:
+            outfd.write("\n%d line%s repeated %s times%s, %.3f s total (%.1f%%):\n" % (
+                    len(sequence), "s" if len(sequence) > 1 else "", format(repeated, ","),
+                    " in %d runs" % runs if runs > 1 else "", ms / 1000, 100 * ms / total))
+            for line in sequence:
+                outfd.write("# %s" % line)
+
+# --- Parallel processing ---
+
+# Large files are split into chunks of about this many bytes, compressed in
+# parallel
+CHUNK_SIZE = 64 << 20
+# Lines a chunk is processed past its end, at least, to find a point where
+# its state and that of the next chunk, which starts from scratch, are the
+# same. They usually meet within a few windows.
+CHUNK_OVERLAP_LINES = 20000
+
+class CountingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.chars = 0
+
+    def write(self, text):
+        self.chars += len(text)
+        self.f.write(text)
+
+ChunkResult = collections.namedtuple("ChunkResult",
+        "start end path head tail complete state end_chars")
+
+def compress_chunk(path, start, end, window, overlap, out_dir, state=None):
+    """Compress the lines of file `path` from byte offset `start` to `end`,
+    or its end if that is None, as if the log started at `start`, or
+    continuing from `state`, and go on for up to `overlap` lines past `end`.
+    Both offsets are at the start of a line. The output is written to a file
+    in out_dir.
+
+    Returns a ChunkResult. Its head maps the states reached in the first
+    `overlap` lines to how many characters had been written by then, and
+    tail lists the states reached past `end` with the same. A state is
+    (lines processed, first line in the window), counted from `start` for
+    head and from `end` for tail. Only states without an open repetition
+    are recorded, as those are fully described by it: two runs in the same
+    state write the same output from there on. state is the pickled state
+    at `end`, after end_chars characters of output, to continue from.
+    complete is set if the end of the file was reached, in which case the
+    output is final."""
+    fd, out_path = tempfile.mkstemp(dir=out_dir)
+    head = {}
+    tail = []
+    if state:
+        lines, current_repetition = pickle.loads(state)
+    else:
+        lines, current_repetition = LineWindow(), None
+    with open_log(path) as f, open(fd, "w", encoding="utf-8", errors="surrogateescape",
+            newline="") as out:
+        if start:
+            f.seek(start)
+        outfd = CountingWriter(out)
+        processed = lines.start + len(lines)
+        record_head = start and not state
+
+        for line in read_lines(f, end):
+            lines.append(line)
+            if len(lines) > window:
+                current_repetition = shorten_buffer(outfd, lines, current_repetition)
+            processed += 1
+            if record_head and processed <= overlap and not current_repetition:
+                head[(processed, lines.start)] = outfd.chars
+        chunk_lines = processed
+
+        if end is None:
+            state = None
+        else:
+            state = pickle.dumps((lines, current_repetition), pickle.HIGHEST_PROTOCOL)
+        end_chars = outfd.chars
+
+        complete = True
+        for line in read_lines(f):
+            if processed - chunk_lines >= overlap:
+                complete = False
+                break
+            lines.append(line)
+            if len(lines) > window:
+                current_repetition = shorten_buffer(outfd, lines, current_repetition)
+            processed += 1
+            if not current_repetition:
+                tail.append((processed - chunk_lines, lines.start - chunk_lines, outfd.chars))
+        if complete:
+            finish(outfd, lines, current_repetition)
+    return ChunkResult(start, end, out_path, head, tail, complete, state, end_chars)
+
+def chunk_boundaries(path, chunk_size):
+    """Return the offsets of the first line of every chunk of the file,
+    and None for its end. Compressed files are not split, as they cannot be
+    read from the middle."""
+    bounds = [0]
+    with open(path, "rb") as f:
+        if compression_format(f):
+            return [0, None]
+        size = os.fstat(f.fileno()).st_size
+        while bounds[-1] + chunk_size < size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(None)
+    return bounds
+
+def find_sync(current, following):
+    """Return (characters of current's output, characters of following's
+    output) at the first state past the end of current that both chunks
+    reach, or None."""
+    for step, start, chars in current.tail:
+        following_chars = following.head.get((step, start))
+        if following_chars is not None:
+            return chars, following_chars
+    return None
+
+def copy_output(path, skip, stop, outfd, block=1 << 20):
+    """Write the characters of a chunk's output from `skip` up to `stop`,
+    or the end if stop is None."""
+    remaining = None if stop is None else stop - skip
+    with open(path, encoding="utf-8", errors="surrogateescape", newline="") as f:
+        while skip:
+            skip -= len(f.read(min(skip, block)))
+        while remaining is None or remaining > 0:
+            data = f.read(block if remaining is None else min(remaining, block))
+            if not data:
+                break
+            outfd.write(data)
+            if remaining is not None:
+                remaining -= len(data)
+
+def write_chunks(path, futures, outfd, window, overlap, out_dir):
+    """Write the output of the chunks of one file, stitched together where
+    the state of one chunk runs into that of the next, so it is the same as
+    compress_log() would write. Where the states do not meet within the
+    overlap, e.g. in a repetition longer than that, the next chunk is
+    compressed again, continuing from the state the first one ended in."""
+    current = futures[0].result()
+    skip = 0
+    for i, future in enumerate(futures[1:], 1):
+        if current.complete:
+            for following in futures[i:]:
+                following.cancel()
+            break
+        following = future.result()
+        sync = find_sync(current, following)
+        if sync is None:
+            copy_output(current.path, skip, current.end_chars, outfd)
+            current = compress_chunk(path, following.start, following.end, window, overlap,
+                    out_dir, current.state)
+            skip = 0
+            continue
+        stop, following_skip = sync
+        copy_output(current.path, skip, stop, outfd)
+        current, skip = following, following_skip
+    copy_output(current.path, skip, None, outfd)
+
+def compress_files(paths, outfd, window, jobs, chunk_size=CHUNK_SIZE, overlap=None):
+    """Like compress_log() on each file in turn, with `jobs` processes
+    compressing the files, and chunks of large files, concurrently."""
+    if overlap is None:
+        overlap = max(CHUNK_OVERLAP_LINES, 10 * window)
+    with tempfile.TemporaryDirectory(prefix="filter_openocd_log_") as out_dir, \
+            concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        files = []
+        for path in paths:
+            bounds = chunk_boundaries(path, chunk_size)
+            files.append((path, [pool.submit(compress_chunk, path, start, end, window, overlap,
+                    out_dir) for start, end in zip(bounds, bounds[1:])]))
+        for path, futures in files:
+            write_chunks(path, futures, outfd, window, overlap, out_dir)
 
 def main(args):
     import argparse
@@ -105,16 +734,60 @@ def main(args):
             epilog='If no files are specified, read standard input.',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('file', nargs='*', help='input file')
-    parser.add_argument('-o', '--output', help='output file', default=sys.stdout)
+    parser.add_argument('-o', '--output',
+            help='output file, compressed if its name ends in .gz, .bz2, .xz or .zst')
+    parser.add_argument('-z', '--compress', choices=COMPRESSION_FORMATS,
+            help='compress the output in this format (compressed input, in any '
+            'of them, is recognised without this)')
     parser.add_argument('-w', '--window', type=int, default=400,
             help='number of lines to consider when looking for repetitions')
+    parser.add_argument('-f', '--follow', action='store_true',
+            help='process input as it arrives, e.g. from a running OpenOCD, '
+            'and show repetitions still going on as running counters; a file '
+            'is followed until interrupted')
+    parser.add_argument('--flush-lines', type=int, default=1000,
+            help='in follow mode, write out pending lines after this many '
+            'new lines')
+    parser.add_argument('--flush-interval', type=float, default=0.5,
+            help='in follow mode, write out pending lines after this many '
+            'seconds')
+    parser.add_argument('-p', '--profile', action='store_true',
+            help='instead of the compressed log, report where the time went by '
+            'the time stamps of the lines, per source location and per '
+            'repeated block; the log must have been written at debug_level 3')
+    parser.add_argument('--top', type=int, default=20,
+            help='with --profile, locations and repeated blocks to list')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='compress files, and chunks of large files, in this many '
+            'processes; the output is the same')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE >> 20,
+            help='with --jobs, split files into chunks of this many MiB')
     args = parser.parse_args(args)
 
-    if args.file:
-        for f in args.file:
-            compress_log(open(f, "r"), args.output, args.window)
-    else:
-        compress_log(sys.stdin, args.output, args.window)
+    if args.follow:
+        if len(args.file) > 1:
+            parser.error('only one file can be followed')
+        if args.jobs > 1:
+            parser.error('--jobs cannot be used with --follow')
+    if args.profile and (args.follow or args.jobs > 1):
+        parser.error('--profile cannot be used with --follow or --jobs')
+
+    with open_output(args.output, args.compress) as outfd:
+        if args.follow:
+            infd = open(args.file[0], "rb") if args.file else sys.stdin
+            follow_log(infd, outfd, args.window, args.flush_lines, args.flush_interval)
+        elif args.file and args.jobs > 1:
+            compress_files(args.file, outfd, args.window, args.jobs, args.chunk_size << 20)
+        elif args.profile:
+            profile = TimingProfile()
+            for f in args.file or [sys.stdin.buffer]:
+                with open_log(f) as infd:
+                    compress_log(profile.read(read_lines(infd)), profile, args.window)
+            profile.report(outfd, args.top)
+        else:
+            for f in args.file or [sys.stdin.buffer]:
+                with open_log(f) as infd:
+                    compress_log(read_lines(infd), outfd, args.window)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))